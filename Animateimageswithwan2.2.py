@@ -5,28 +5,47 @@ import time
 import uuid
 import glob
 import sys
-import base64
-import io
-import requests
+import queue
+import threading
 import keyboard
 import websocket
-from PIL import Image
 from tqdm import tqdm
+from comfy_workflow import WorkflowTemplate, WorkflowError
+from comfy_dispatch import ComfyDispatcher
+from completion_journal import CompletionJournal
+from prompt_cache import make_prompt_key
+from phash_index import PerceptualIndex, dhash_image
+from lm_client import VisionClient, LMError
+from image_prep import ImagePrep
+from pipeline_metrics import Metrics, timed_iter
 
 # =================================================================================
 #  CONFIGURATION SECTION
 # =================================================================================
 
 # --- ComfyUI Settings ---
-COMFY_SERVER_ADDRESS = "127.0.0.1:8188"
+# One or more ComfyUI servers; each video goes to the one with the shortest queue
+COMFY_SERVER_ADDRESSES = [
+    "127.0.0.1:8188",
+]
 WORKFLOW_FILE = "wan2.2_infinite_video_lightning edition-painter jakes version x.json"
-HISTORY_FILE = "completed_files.json"
+HISTORY_FILE = "completed_files.json"     # Legacy list, imported into the journal once
+JOURNAL_FILE = "completed_files.jsonl"    # Append-only record of every finished video
+
+# Workflow injection points: name -> (Node ID, input name)
+WORKFLOW_NODES = {
+    "image": ("113", "image"),             # Load Image
+    "prompt": ("195", "text"),             # CLIP Text Encode (The Vision Prompt)
+    "output_prefix": ("206", "filename_prefix"),  # Video Save Name
+    "seed": ("117", "noise_seed"),         # Randomize Seed
+}
 
 # --- LM Studio / Qwen Settings ---
 # IP from your reimagine.py script
 LM_STUDIO_URL = "http://192.168.2.192:1234/v1/chat/completions" 
 MODEL_ID = "qwen3-vl-8b-instruct-abliterated-v2.0"
 LM_TIMEOUT = 120
+LM_MAX_RETRIES = 2      # Retries on timeouts, dropped connections and 5xx, with jittered backoff
 
 # The instruction for Qwen
 VISION_SYSTEM_PROMPT = "Design a prompt for a video AI to animate this image in a believable way.  Describe a set of motions and emotions that fit into a 5 second shot.  Be sure to design the shot to include character motion  Examples: she is laughing, breathing heavily, talking excitedly, standing, sitting, dancing, bouncing, etc.  Make sure the motion you describe fits the scene in a plausible way.  Provide the details and animation description ONLY as your response, no additional text, titles, or notes."
@@ -35,55 +54,56 @@ VISION_SYSTEM_PROMPT = "Design a prompt for a video AI to animate this image in
 CANCEL_HOTKEY = "end" 
 IMAGE_EXTENSIONS = ['*.png', '*.jpg', '*.jpeg', '*.webp']
 
+# --- Pipeline Settings ---
+# Keep the ComfyUI queue full: analyze and upload the next images while a video renders
+ENABLE_PIPELINE = True
+MAX_IN_FLIGHT = 2    # Videos queued on each ComfyUI server at once
+PREFETCH = 2         # Images analyzed + uploaded ahead of the ComfyUI queue
+PREP_WORKERS = 2     # Processes resizing/encoding images ahead of the vision model
+PAYLOAD_CACHE_FILE = "vision_payloads.db"   # Encoded images keyed by content hash
+
+# --- Near-Duplicate Detection ---
+# Resized/recompressed copies of an image already analyzed skip the vision call
+ENABLE_PHASH = True
+PHASH_FILE = "phash_index.db"
+PHASH_MAX_DISTANCE = 4      # Differing bits (of 64) that still count as the same picture
+NEAR_DUP_ACTION = "reuse"   # "reuse" the earlier animation prompt, or "skip" the image
+
+# --- Metrics ---
+METRICS_FILE = "animate_metrics.jsonl"   # Per-image stage timings, appended as they happen (None to disable)
+METRICS_PROM_FILE = None                 # e.g. a node_exporter textfile-collector path ending in .prom
+
 # =================================================================================
 #  VISION / LLM FUNCTIONS
 # =================================================================================
 
-def process_and_encode_image(image_path, max_size=768):
-    """Resizes and encodes image for the Vision model (borrowed from reimagine.py)"""
+# One pooled session for every vision call; only the prefetch thread talks to LM Studio
+metrics = Metrics("animate", METRICS_FILE, METRICS_PROM_FILE)
+lm = VisionClient(LM_STUDIO_URL, MODEL_ID, timeout=LM_TIMEOUT, max_concurrency=1,
+                  max_retries=LM_MAX_RETRIES, metrics=metrics)
+prep = ImagePrep(PAYLOAD_CACHE_FILE, PREP_WORKERS)
+
+def process_and_encode_image(image_path):
+    """Resizes and encodes image for the Vision model (shared with reimagine.py via image_prep)"""
     try:
-        with Image.open(image_path) as img:
-            if img.mode != 'RGB':
-                img = img.convert('RGB')
-            
-            # Resize if too large to save token context/speed
-            if max(img.size) > max_size:
-                img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
-            
-            buffered = io.BytesIO()
-            img.save(buffered, format="JPEG", quality=85)
-            return base64.b64encode(buffered.getvalue()).decode('utf-8')
+        return prep.encode(image_path)
     except Exception as e:
         print(f"Error encoding image: {e}")
         return None
 
-def get_animation_prompt(image_path):
+def get_animation_prompt(image_path, base64_image=None):
     """Asks Qwen to generate an animation prompt for the image."""
-    base64_image = process_and_encode_image(image_path)
+    if base64_image is None:
+        base64_image = process_and_encode_image(image_path)
     if not base64_image:
         return None
 
-    messages = [
-        {"role": "user", "content": [
-            {"type": "text", "text": VISION_SYSTEM_PROMPT},
-            {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}}
-        ]}
-    ]
-
-    payload = {
-        "model": MODEL_ID,
-        "messages": messages,
-        "temperature": 0.7,
-        "max_tokens": 200 # Short, concise prompt
-    }
-
     try:
-        response = requests.post(LM_STUDIO_URL, json=payload, timeout=LM_TIMEOUT)
-        response.raise_for_status()
-        content = response.json()['choices'][0]['message']['content'].strip()
+        # Short, concise prompt
+        content = lm.describe(VISION_SYSTEM_PROMPT, base64_image, temperature=0.7, max_tokens=200)
         # Clean up any quotes if the LLM adds them
         return content.replace('"', '').replace("'", "")
-    except Exception as e:
+    except LMError as e:
         print(f"\n[!] LM Studio Error for {image_path}: {e}")
         return None
 
@@ -91,104 +111,127 @@ def get_animation_prompt(image_path):
 #  COMFYUI API FUNCTIONS
 # =================================================================================
 
+# Returned by animation_prompt_for for near-duplicates skipped on purpose (not an LM failure)
+SKIPPED = object()
+
+def animation_prompt_for(filename, near_dups=None, base64_image=None, phash=None):
+    """Animation prompt for an image, reusing the one from a near-duplicate when possible.
+    phash comes from the prep stage when it has already read the file.
+    Returns None when LM Studio failed, SKIPPED when the image is a near-duplicate to skip."""
+    if near_dups is not None:
+        if phash is None:
+            try:
+                phash = dhash_image(filename)
+            except Exception as e:
+                print(f"\nCould not hash {filename}: {e}")
+        match = near_dups.find(phash) if phash is not None else None
+        if match:
+            if NEAR_DUP_ACTION == "skip":
+                print(f"\nSkipping {filename}: near-duplicate of an image already animated.")
+                return SKIPPED
+            return match[0]
+
+    with metrics.span("vision", filename):
+        vision_prompt = get_animation_prompt(filename, base64_image)
+    if vision_prompt and phash is not None:
+        near_dups.add(phash, vision_prompt, filename)
+    return vision_prompt
+
 def get_unique_client_id():
     return str(uuid.uuid4())
 
 def load_workflow(filename):
-    if not os.path.exists(filename):
-        print(f"Error: Workflow file '{filename}' not found.")
-        sys.exit(1)
-    with open(filename, 'r', encoding='utf-8') as f:
-        return json.load(f)
-
-def load_history():
-    if os.path.exists(HISTORY_FILE):
-        try:
-            with open(HISTORY_FILE, 'r') as f:
-                return json.load(f)
-        except:
-            return []
-    return []
-
-def save_history(processed_list):
-    with open(HISTORY_FILE, 'w') as f:
-        json.dump(processed_list, f, indent=4)
-
-def upload_image(filepath):
-    """Uploads image to ComfyUI."""
-    url = f"http://{COMFY_SERVER_ADDRESS}/upload/image"
     try:
-        with open(filepath, 'rb') as f:
-            files = {'image': f}
-            data = {'overwrite': 'true'} 
-            response = requests.post(url, files=files, data=data)
-        
-        if response.status_code == 200:
-            return response.json()['name']
-    except Exception as e:
-        print(f"\nFailed to upload image: {e}")
-    return None
+        return WorkflowTemplate.load(filename, WORKFLOW_NODES, strict=True)
+    except WorkflowError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
 
-def queue_prompt(prompt_workflow, client_id):
-    p = {"prompt": prompt_workflow, "client_id": client_id}
-    try:
-        response = requests.post(f"http://{COMFY_SERVER_ADDRESS}/prompt", json=p)
-        return response.json()
-    except Exception as e:
-        print(f"Error queuing prompt: {e}")
-        return None
+def upload_image(dispatcher, filepath):
+    """Uploads image to the least-loaded ComfyUI server, failing over if it is down.
+    Returns (endpoint, uploaded name); the job must be queued on that same endpoint."""
+    tried = []
+    for _ in range(len(dispatcher.endpoints)):
+        # A server that rejected the upload isn't marked down, so it has to be excluded explicitly
+        endpoint = dispatcher.pick(exclude=tried)
+        if endpoint is None:
+            break
+        tried.append(endpoint)
+        with metrics.span("upload", filepath):
+            name = dispatcher.upload_image(filepath, endpoint)
+        if name:
+            return endpoint, name
+    return None, None
+
+def queue_prompt(dispatcher, endpoint, prompt_workflow, client_id):
+    with metrics.span("comfy_submit"):
+        _, prompt_id = dispatcher.submit(prompt_workflow, client_id=client_id, endpoint=endpoint)
+    return prompt_id
+
+def record_render(item, queued_at, started_at, finished_at, ok=True):
+    """Splits a render into time waiting in ComfyUI's queue and time executing."""
+    if started_at is None:
+        metrics.record("comfy_total", finished_at - queued_at, item, ok=ok)
+        return
+    metrics.record("comfy_queue_wait", max(0.0, started_at - queued_at), item)
+    metrics.record("comfy_execution", finished_at - started_at, item, ok=ok)
 
-def track_progress(prompt_id, ws):
+def track_progress(prompt_id, ws, queued_at=None, item=None):
     """Waits for the prompt to finish via Websocket."""
+    queued_at = queued_at or time.perf_counter()
+    started_at = None
     while True:
         try:
             out = ws.recv()
             if isinstance(out, str):
                 message = json.loads(out)
+                data = message.get('data', {})
+                if message['type'] == 'execution_start' and data.get('prompt_id') == prompt_id:
+                    started_at = time.perf_counter()
                 if message['type'] == 'executing':
-                    data = message['data']
                     if data['node'] is None and data['prompt_id'] == prompt_id:
+                        record_render(item or prompt_id, queued_at, started_at, time.perf_counter())
                         return True # Execution finished
         except Exception:
             return False
 
+def listen_for_completions(address, ws, completions, shutdown, ws_times=None):
+    """Reads one server's websocket and reports (prompt_id, success) for every finished prompt
+    until `shutdown` is set. ws_times, if given, collects {"start": t, "end": t} per prompt_id
+    for queue/execution timings."""
+    ws.settimeout(1)
+    while not shutdown.is_set():
+        try:
+            out = ws.recv()
+        except websocket.WebSocketTimeoutException:
+            continue
+        except Exception:
+            completions.put((f"closed:{address}", False))
+            return
+        if not isinstance(out, str):
+            continue  # Binary preview frames
+        try:
+            message = json.loads(out)
+            data = message.get('data') or {}
+            prompt_id = data.get('prompt_id')
+            kind = message.get('type')
+        except (ValueError, AttributeError):
+            continue  # A malformed frame must not take the listener (and its server's jobs) down
+        if ws_times is not None and prompt_id:
+            if kind == 'execution_start':
+                ws_times.setdefault(prompt_id, {})["start"] = time.perf_counter()
+            elif kind == 'execution_error' or (kind == 'executing' and data.get('node') is None):
+                ws_times.setdefault(prompt_id, {})["end"] = time.perf_counter()
+        if kind == 'executing' and data.get('node') is None and prompt_id:
+            completions.put((prompt_id, True))
+        elif kind == 'execution_error' and prompt_id:
+            completions.put((prompt_id, False))
+
 # =================================================================================
 #  MAIN LOGIC
 # =================================================================================
 
-def main():
-    print("### ComfyUI + Qwen Vision Automation Started ###")
-    print(f"Press '{CANCEL_HOTKEY}' to cancel after the current video finishes.\n")
-
-    client_id = get_unique_client_id()
-    ws = websocket.WebSocket()
-    
-    try:
-        ws.connect(f"ws://{COMFY_SERVER_ADDRESS}/ws?clientId={client_id}")
-    except Exception as e:
-        print(f"Could not connect to ComfyUI at {COMFY_SERVER_ADDRESS}. Is it running?")
-        return
-
-    workflow = load_workflow(WORKFLOW_FILE)
-
-    # Scan and Filter Files
-    files = []
-    for ext in IMAGE_EXTENSIONS:
-        files.extend(glob.glob(ext))
-    
-    completed = load_history()
-    files_to_process = [f for f in files if f not in completed and f != "completed_files.json" and not f.endswith('.json')]
-    
-    # --- RANDOMIZE LIST ---
-    random.shuffle(files_to_process)
-    # ----------------------
-
-    if not files_to_process:
-        print("No new images found to process.")
-        return
-
-    print(f"Found {len(files_to_process)} images to process.")
-
+def run_sequential(dispatcher, sockets, workflow, client_id, files_to_process, journal, near_dups=None):
     pbar = tqdm(files_to_process, unit="video")
     
     for filename in pbar:
@@ -198,9 +241,12 @@ def main():
 
         pbar.set_description(f"Analyzing: {filename}")
         
-        # 1. Get Prompt from Qwen
-        vision_prompt = get_animation_prompt(filename)
-        
+        # 1. Get Prompt from Qwen (or from a near-duplicate already analyzed)
+        vision_prompt = animation_prompt_for(filename, near_dups)
+        if vision_prompt is SKIPPED:
+            # Journaled so later runs don't hash it again
+            journal.add(filename, skipped="near-duplicate")
+            continue
         if not vision_prompt:
             print(f"\nSkipping {filename}: Could not generate prompt from LM Studio.")
             continue
@@ -211,35 +257,32 @@ def main():
         pbar.set_description(f"Rendering: {filename}")
 
         # 2. Upload Image to Comfy
-        comfy_filename = upload_image(filename)
+        endpoint, comfy_filename = upload_image(dispatcher, filename)
         if not comfy_filename:
             continue
 
-        # 3. Update Workflow Nodes
-        # Node 113: Load Image
-        workflow['113']['inputs']['image'] = comfy_filename
-        
-        # Node 195: CLIP Text Encode (The Vision Prompt)
-        workflow['195']['inputs']['text'] = vision_prompt
-        
-        # Node 206: Video Save Name
+        # 3. Render the job from the template (only the patched nodes are copied)
         base_name = os.path.splitext(filename)[0]
-        workflow['206']['inputs']['filename_prefix'] = f"{base_name}_animation"
-        
-        # Node 117: Randomize Seed
         seed = random.randint(1, 1000000000000000)
-        workflow['117']['inputs']['noise_seed'] = seed
+        prompt_workflow = workflow.render(
+            image=comfy_filename,
+            prompt=vision_prompt,
+            output_prefix=f"{base_name}_animation",
+            seed=seed,
+        )
 
         # 4. Execute
         try:
-            prompt_response = queue_prompt(workflow, client_id)
-            if prompt_response:
-                prompt_id = prompt_response['prompt_id']
-                track_progress(prompt_id, ws)
+            queued_at = time.perf_counter()
+            prompt_id = queue_prompt(dispatcher, endpoint, prompt_workflow, client_id)
+            if prompt_id:
+                track_progress(prompt_id, sockets[endpoint.address], queued_at, filename)
                 
                 # 5. Save History
-                completed.append(filename)
-                save_history(completed)
+                journal.add(
+                    filename, prompt_id=prompt_id, seed=seed, prompt=vision_prompt,
+                    output=f"{base_name}_animation", server=endpoint.address
+                )
             else:
                 print(f"Failed to trigger generation for {filename}")
             
@@ -247,7 +290,221 @@ def main():
             print(f"\nError processing {filename}: {e}")
             time.sleep(2)
 
-    ws.close()
+def prepare_job(dispatcher, filename, near_dups=None, base64_image=None, phash=None):
+    """Vision prompt + upload for one image. Runs on the prefetch thread.
+    Returns the job, None on failure or SKIPPED."""
+    vision_prompt = animation_prompt_for(filename, near_dups, base64_image, phash)
+    if vision_prompt is SKIPPED:
+        return SKIPPED
+    if not vision_prompt:
+        print(f"\nSkipping {filename}: Could not generate prompt from LM Studio.")
+        return None
+
+    endpoint, comfy_filename = upload_image(dispatcher, filename)
+    if not comfy_filename:
+        return None
+    return {"filename": filename, "prompt": vision_prompt, "endpoint": endpoint, "image": comfy_filename}
+
+def prefetch_worker(dispatcher, files, ready, stop_event, near_dups=None):
+    """Analyzes and uploads images ahead of the ComfyUI queue; blocks once PREFETCH jobs are waiting.
+    Resizing/encoding runs in a process pool a few images further ahead still."""
+    scanned = prep.iter_prepared(files, ahead=PREP_WORKERS, phash=near_dups is not None)
+    for filename, _, base64_image, _, error, phash in timed_iter(scanned, metrics, "scan_wait"):
+        if stop_event.is_set():
+            break
+        job = None
+        if error:
+            print(f"\nError encoding image {filename}: {error}")
+        else:
+            try:
+                job = prepare_job(dispatcher, filename, near_dups, base64_image, phash)
+            except Exception as e:
+                print(f"\nError preparing {filename}: {e}")
+        # A bare filename tells the main loop the image failed, (SKIPPED, filename) that it was skipped
+        item = (SKIPPED, filename) if job is SKIPPED else (job if job else filename)
+        while not stop_event.is_set():
+            try:
+                ready.put(item, timeout=0.5)
+                break
+            except queue.Full:
+                continue
+    ready.put(None)
+
+def run_pipelined(dispatcher, sockets, workflow, client_id, files_to_process, journal, near_dups=None):
+    stop_event = threading.Event()        # Cancel: stop submitting, let queued videos finish
+    listeners_done = threading.Event()    # Set once nothing is in flight any more
+    ready = queue.Queue(maxsize=max(1, PREFETCH))
+    completions = queue.Queue()
+    ws_times = {}  # prompt_id -> {"start", "end"}, filled by the websocket listeners
+
+    for address, ws in sockets.items():
+        threading.Thread(target=listen_for_completions, args=(address, ws, completions, listeners_done, ws_times), daemon=True).start()
+    threading.Thread(target=prefetch_worker, args=(dispatcher, files_to_process, ready, stop_event, near_dups), daemon=True).start()
+
+    in_flight = {}  # prompt_id -> job
+    listening = set(sockets)  # Servers whose websocket is still open
+    exhausted = False
+    pbar = tqdm(total=len(files_to_process), unit="video")
+
+    while True:
+        if not stop_event.is_set() and keyboard.is_pressed(CANCEL_HOTKEY):
+            print(f"\nCancel requested. Waiting for {len(in_flight)} queued video(s) to finish...")
+            stop_event.set()
+
+        # 1. Top up the ComfyUI queue from the prefetched jobs
+        while not stop_event.is_set() and not exhausted \
+                and len(in_flight) < MAX_IN_FLIGHT * max(1, len(dispatcher.endpoints)):
+            try:
+                job = ready.get(timeout=0.1 if in_flight else 0.5)
+            except queue.Empty:
+                break
+            if job is None:
+                exhausted = True
+                break
+            if isinstance(job, str):
+                pbar.update(1)
+                continue
+            if isinstance(job, tuple):
+                journal.add(job[1], skipped="near-duplicate")
+                pbar.update(1)
+                continue
+
+            if job["endpoint"] not in dispatcher.endpoints:
+                # Uploaded ahead to a server that has since dropped: upload again elsewhere
+                dispatcher.release(job["endpoint"])
+                job["endpoint"], job["image"] = upload_image(dispatcher, job["filename"])
+                if not job["image"]:
+                    print(f"\nSkipping {job['filename']}: no ComfyUI server to upload it to.")
+                    pbar.update(1)
+                    continue
+
+            base_name = os.path.splitext(job["filename"])[0]
+            job["seed"] = random.randint(1, 1000000000000000)
+            job["output"] = f"{base_name}_animation"
+            prompt_workflow = workflow.render(
+                image=job["image"],
+                prompt=job["prompt"],
+                output_prefix=job["output"],
+                seed=job["seed"],
+            )
+            job["queued_at"] = time.perf_counter()
+            prompt_id = queue_prompt(dispatcher, job["endpoint"], prompt_workflow, client_id)
+            if prompt_id:
+                in_flight[prompt_id] = job
+            else:
+                print(f"Failed to trigger generation for {job['filename']}")
+                pbar.update(1)
+
+        if not in_flight:
+            if exhausted or stop_event.is_set():
+                break
+            continue
+
+        pbar.set_description(f"Rendering: {len(in_flight)} queued")
+
+        # 2. Match websocket completions back to their files by prompt_id
+        try:
+            prompt_id, success = completions.get(timeout=0.5)
+        except queue.Empty:
+            continue
+
+        if prompt_id.startswith("closed:"):
+            # That server's websocket died; its queued videos can no longer be tracked
+            address = prompt_id[len("closed:"):]
+            listening.discard(address)
+            for endpoint in dispatcher.endpoints:
+                if endpoint.address == address:
+                    dispatcher.retire(endpoint, "websocket closed")
+            lost = [pid for pid, job in in_flight.items() if job["endpoint"].address == address]
+            for pid in lost:
+                print(f"\nLost track of {in_flight.pop(pid)['filename']} (connection to {address} closed)")
+                pbar.update(1)
+            if not listening:
+                # Nothing can report a completion any more; unfinished files are retried next run
+                print("\n[!] Every ComfyUI connection closed. Stopping.")
+                break
+            continue
+
+        job = in_flight.pop(prompt_id, None)
+        times = ws_times.pop(prompt_id, {})
+        if job is None:
+            continue  # Not one of ours
+        record_render(job["filename"], job["queued_at"], times.get("start"),
+                      times.get("end", time.perf_counter()), ok=success)
+        if success:
+            journal.add(
+                job["filename"], prompt_id=prompt_id, seed=job["seed"], prompt=job["prompt"],
+                output=job["output"], server=job["endpoint"].address
+            )
+        else:
+            print(f"\nComfyUI reported an error rendering {job['filename']}")
+        pbar.update(1)
+
+    stop_event.set()
+    listeners_done.set()
+    pbar.close()
+
+def main():
+    print("### ComfyUI + Qwen Vision Automation Started ###")
+    print(f"Press '{CANCEL_HOTKEY}' to cancel after the current video finishes.\n")
+
+    client_id = get_unique_client_id()
+    dispatcher = ComfyDispatcher(COMFY_SERVER_ADDRESSES)
+
+    # One websocket per server, keyed by host:port; unreachable servers are dropped
+    sockets = {}
+    for endpoint in dispatcher.endpoints:
+        ws = websocket.WebSocket()
+        try:
+            ws.connect(f"ws://{endpoint.address}/ws?clientId={client_id}")
+            sockets[endpoint.address] = ws
+        except Exception as e:
+            print(f"Could not connect to ComfyUI at {endpoint.address}. Is it running?")
+    
+    if not sockets:
+        return
+    dispatcher.endpoints = [e for e in dispatcher.endpoints if e.address in sockets]
+
+    workflow = load_workflow(WORKFLOW_FILE)
+
+    # Scan and Filter Files
+    files = []
+    for ext in IMAGE_EXTENSIONS:
+        files.extend(glob.glob(ext))
+    
+    journal = CompletionJournal(JOURNAL_FILE, legacy_file=HISTORY_FILE)
+    files_to_process = [f for f in files if f not in journal and not f.endswith(('.json', '.jsonl'))]
+    
+    # --- RANDOMIZE LIST ---
+    random.shuffle(files_to_process)
+    # ----------------------
+
+    if not files_to_process:
+        print("No new images found to process.")
+        return
+
+    print(f"Found {len(files_to_process)} images to process.")
+
+    near_dups = None
+    if ENABLE_PHASH:
+        near_dups = PerceptualIndex(
+            f"animate:{make_prompt_key(VISION_SYSTEM_PROMPT, MODEL_ID)}", PHASH_FILE, PHASH_MAX_DISTANCE
+        )
+
+    if ENABLE_PIPELINE:
+        run_pipelined(dispatcher, sockets, workflow, client_id, files_to_process, journal, near_dups)
+    else:
+        run_sequential(dispatcher, sockets, workflow, client_id, files_to_process, journal, near_dups)
+
+    if near_dups is not None:
+        print(f"\nNear-duplicates found: {near_dups.hits}")
+        near_dups.close()
+
+    for ws in sockets.values():
+        ws.close()
+    prep.close()
+    print(lm.stats.report())
+    metrics.close()
     print("\nBatch processing finished.")
 
 if __name__ == "__main__":
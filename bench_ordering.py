@@ -0,0 +1,99 @@
+import os
+import sys
+import time
+import random
+import argparse
+import reimagine
+from comfy_workflow import WorkflowTemplate, WorkflowError
+from comfy_dispatch import ComfyDispatcher
+
+# =================================================================================
+#  JOB ORDERING BENCHMARK
+#  Renders the same images through ComfyUI once per ordering strategy (fixed
+#  prompt, no LLM involved) and reports throughput and resolution switches, to
+#  see what grouping jobs by resolution bucket buys on a given GPU/workflow.
+#
+#  python bench_ordering.py [folder] --jobs 40 --strategies random,bucketed
+#  python bench_ordering.py [folder] --dry-run    (switch counts only, no ComfyUI)
+# =================================================================================
+
+BENCH_PROMPT = "A photograph of a red bicycle leaning against a brick wall, soft morning light."
+
+def count_switches(files, sizes):
+    """How many consecutive jobs change latent size."""
+    switches, previous = 0, None
+    for f in files:
+        size = sizes.get(f)
+        bucket = reimagine.bucket_for_size(*size)[:2] if size else None
+        if previous is not None and bucket != previous:
+            switches += 1
+        previous = bucket
+    return switches
+
+def wait_for_drain(dispatcher, poll=1.0):
+    while True:
+        busy = False
+        for endpoint in dispatcher.endpoints:
+            depth = dispatcher.refresh(endpoint, force=True)
+            if depth:
+                busy = True
+        if not busy:
+            return
+        time.sleep(poll)
+
+def run_strategy(submitter, dispatcher, files, sizes, label):
+    start = time.perf_counter()
+    queued = 0
+    for i, f in enumerate(files):
+        w, h, _ = reimagine.bucket_for_size(*sizes[f])
+        if submitter.send(BENCH_PROMPT, w, h, f"bench/{label}_{i:04d}", seed=1000 + i):
+            queued += 1
+    wait_for_drain(dispatcher)
+    return queued, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare ComfyUI throughput across job ordering strategies.")
+    parser.add_argument("folder", nargs="?", default=".")
+    parser.add_argument("--jobs", type=int, default=40, help="Images per strategy")
+    parser.add_argument("--strategies", default="random,bucketed")
+    parser.add_argument("--server", action="append", help="ComfyUI server (repeatable); default COMFY_URLS")
+    parser.add_argument("--dry-run", action="store_true", help="Only count resolution switches")
+    args = parser.parse_args()
+
+    valid_exts = ('.jpg', '.jpeg', '.png', '.webp')
+    files = [os.path.join(args.folder, f) for f in os.listdir(args.folder) if f.lower().endswith(valid_exts)]
+    reimagine.RESOLUTION_BUCKETS = reimagine.load_buckets(reimagine.BUCKETS_FILE, reimagine.RESOLUTION_BUCKETS)
+    sizes = {f: s for f, s in reimagine.read_sizes(files).items() if s}
+    if not sizes:
+        print("No readable images found.")
+        sys.exit(1)
+    # One subset for every strategy, so only the order differs between runs
+    files = random.sample(list(sizes), min(args.jobs, len(sizes)))
+
+    strategies = [s.strip() for s in args.strategies.split(",") if s.strip()]
+    orders = {s: reimagine.order_files(files, s, sizes) for s in strategies}
+
+    submitter = dispatcher = None
+    if not args.dry_run:
+        try:
+            template = WorkflowTemplate.load(reimagine.WORKFLOW_FILE, reimagine.WORKFLOW_NODES)
+        except WorkflowError as e:
+            print(f"[!] FATAL: {e}")
+            sys.exit(1)
+        dispatcher = ComfyDispatcher(args.server or reimagine.COMFY_URLS)
+        submitter = reimagine.ComfySubmitter(template, dispatcher)
+        print("Waiting for ComfyUI to be idle...")
+        wait_for_drain(dispatcher)
+
+    print(f"{'strategy':<12} {'jobs':>5} {'switches':>9} {'seconds':>9} {'jobs/min':>9}")
+    for label, ordered in orders.items():
+        switches = count_switches(ordered, sizes)
+        if args.dry_run:
+            print(f"{label:<12} {len(ordered):>5} {switches:>9} {'-':>9} {'-':>9}")
+            continue
+        queued, elapsed = run_strategy(submitter, dispatcher, ordered, sizes, label)
+        rate = queued / elapsed * 60 if elapsed else 0.0
+        print(f"{label:<12} {queued:>5} {switches:>9} {elapsed:>9.1f} {rate:>9.2f}")
+
+if __name__ == "__main__":
+    main()
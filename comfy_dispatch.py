@@ -0,0 +1,243 @@
+import time
+import threading
+import requests
+
+# =================================================================================
+#  MULTI-BACKEND COMFYUI DISPATCHER
+#  Routes each job to the least-loaded of several ComfyUI instances, based on
+#  their /queue depth, and fails over to the next one when a server goes down.
+# =================================================================================
+
+def normalize_server(server):
+    """Accepts '127.0.0.1:8188', 'http://127.0.0.1:8188' or the old '.../prompt' URL."""
+    server = server.strip().rstrip('/')
+    if server.endswith('/prompt'):
+        server = server[:-len('/prompt')]
+    if not server.startswith(('http://', 'https://')):
+        server = f"http://{server}"
+    return server
+
+class ComfyEndpoint:
+    def __init__(self, base_url):
+        self.base_url = normalize_server(base_url)
+        # host:port, used for the websocket URL
+        self.address = self.base_url.split('://', 1)[1]
+        self.depth = 0            # running + pending jobs reported by /queue
+        self.submitted = 0        # our submissions since the last /queue poll
+        self.assigned = 0         # images uploaded here whose job isn't queued yet
+        self.last_poll = 0.0
+        self.down_until = 0.0
+        self.failures = 0
+        self.our_ids = set()      # Prompt IDs we queued that were still on the server at the last poll
+        self.pending_ids = set()  # Every pending (not yet running) prompt ID at the last poll
+
+    @property
+    def healthy(self):
+        return time.time() >= self.down_until
+
+    @property
+    def load(self):
+        return self.depth + self.submitted + self.assigned
+
+    def __repr__(self):
+        return f"ComfyEndpoint({self.base_url}, depth={self.depth}, healthy={self.healthy})"
+
+class ComfyDispatcher:
+    def __init__(self, servers, timeout=15, poll_interval=1.0, retry_after=30):
+        if isinstance(servers, str):
+            servers = [servers]
+        if not servers:
+            raise ValueError("At least one ComfyUI server is required")
+        self.endpoints = [ComfyEndpoint(s) for s in servers]
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.retry_after = retry_after
+        self.session = requests.Session()
+        self._lock = threading.Lock()
+
+    def mark_down(self, endpoint, reason=""):
+        with self._lock:
+            endpoint.failures += 1
+            endpoint.down_until = time.time() + self.retry_after
+        print(f"\n[!] ComfyUI at {endpoint.base_url} unavailable{': ' + str(reason) if reason else ''}. "
+              f"Retrying it in {self.retry_after}s.")
+
+    def retire(self, endpoint, reason=""):
+        """Marks a server down and stops routing to it for the rest of the run (e.g. its
+        websocket closed, so nothing queued there could be tracked)."""
+        with self._lock:
+            endpoint.failures += 1
+            endpoint.down_until = float('inf')
+            self.endpoints = [e for e in self.endpoints if e is not endpoint]
+        print(f"\n[!] ComfyUI at {endpoint.base_url} dropped{': ' + str(reason) if reason else ''}. "
+              f"No more jobs go there this run.")
+
+    def release(self, endpoint):
+        """Drops an upload's reservation on its server once the job is queued or abandoned."""
+        with self._lock:
+            endpoint.assigned = max(0, endpoint.assigned - 1)
+
+    def _mark_up(self, endpoint):
+        with self._lock:
+            endpoint.failures = 0
+            endpoint.down_until = 0.0
+
+    def get_queue(self, endpoint):
+        """Returns the raw /queue response ({'queue_running': [...], 'queue_pending': [...]}) or None."""
+        try:
+            response = self.session.get(f"{endpoint.base_url}/queue", timeout=self.timeout)
+            response.raise_for_status()
+            return response.json()
+        except Exception as e:
+            self.mark_down(endpoint, e)
+            return None
+
+    def refresh(self, endpoint, force=False):
+        if not force and time.time() - endpoint.last_poll < self.poll_interval:
+            return endpoint.depth
+        data = self.get_queue(endpoint)
+        if data is None:
+            return None
+        running = data.get('queue_running', [])
+        pending = data.get('queue_pending', [])
+        # Queue entries are [number, prompt_id, prompt, extra_data, outputs]
+        running_ids = {item[1] for item in running if len(item) > 1}
+        pending_ids = {item[1] for item in pending if len(item) > 1}
+        with self._lock:
+            endpoint.depth = len(running) + len(pending)
+            endpoint.submitted = 0
+            endpoint.last_poll = time.time()
+            endpoint.pending_ids = pending_ids
+            endpoint.our_ids &= running_ids | pending_ids  # Forget the ones that finished
+        self._mark_up(endpoint)
+        return endpoint.depth
+
+    def total_depth(self):
+        return sum(e.load for e in self.endpoints if e.healthy)
+
+    def wait_for_capacity(self, high, low, should_stop=None):
+        """Backpressure with hysteresis: once the healthy servers hold `high` jobs each,
+        blocks until they drain to `low` each. Returns False if should_stop() fired first."""
+        healthy = max(1, sum(1 for e in self.endpoints if e.healthy))
+        if self.total_depth() < high * healthy:
+            return True
+        while not (should_stop and should_stop()):
+            for endpoint in self.endpoints:
+                if endpoint.healthy:
+                    self.refresh(endpoint, force=True)
+            healthy = max(1, sum(1 for e in self.endpoints if e.healthy))
+            if self.total_depth() <= low * healthy:
+                return True
+            time.sleep(self.poll_interval)
+        return False
+
+    def outstanding(self):
+        """Our prompts that were still queued or running at the last poll."""
+        return sum(len(e.our_ids) for e in self.endpoints)
+
+    def cancel_pending(self):
+        """Removes our not-yet-started prompts from every server's queue. Returns how many were deleted.
+        Jobs already running are left to finish."""
+        cancelled = 0
+        for endpoint in self.endpoints:
+            if not endpoint.our_ids or self.refresh(endpoint, force=True) is None:
+                continue
+            with self._lock:
+                ids = sorted(endpoint.our_ids & endpoint.pending_ids)
+            if not ids:
+                continue
+            try:
+                response = self.session.post(f"{endpoint.base_url}/queue", json={"delete": ids}, timeout=self.timeout)
+                response.raise_for_status()
+            except requests.exceptions.RequestException as e:
+                print(f"\n[!] Could not cancel queued prompts on {endpoint.base_url}: {e}")
+                continue
+            with self._lock:
+                endpoint.our_ids -= set(ids)
+                endpoint.pending_ids -= set(ids)
+            cancelled += len(ids)
+        return cancelled
+
+    def pick(self, exclude=()):
+        """Least-loaded healthy endpoint, or None when every server is down."""
+        candidates = []
+        for endpoint in self.endpoints:
+            if endpoint in exclude or not endpoint.healthy:
+                continue
+            if self.refresh(endpoint) is None:
+                continue
+            candidates.append(endpoint)
+        if not candidates:
+            return None
+        return min(candidates, key=lambda e: e.load)
+
+    def submit(self, workflow, client_id=None, endpoint=None):
+        """Queues a workflow and returns (endpoint, prompt_id), or (None, None) on failure.
+
+        With an explicit endpoint (e.g. one an image was uploaded to) there is no failover, and
+        the reservation upload_image made on it is released."""
+        if endpoint is not None:
+            self.release(endpoint)
+        payload = {"prompt": workflow}
+        if client_id:
+            payload["client_id"] = client_id
+
+        tried = []
+        while True:
+            target = endpoint or self.pick(exclude=tried)
+            if target is None:
+                print("\n[!] No ComfyUI server available.")
+                return None, None
+            tried.append(target)
+            try:
+                response = self.session.post(f"{target.base_url}/prompt", json=payload, timeout=self.timeout)
+            except requests.exceptions.RequestException as e:
+                self.mark_down(target, e)
+                if endpoint:
+                    return None, None
+                continue
+
+            if response.status_code >= 500:
+                self.mark_down(target, f"HTTP {response.status_code}")
+                if endpoint:
+                    return None, None
+                continue
+            if response.status_code != 200:
+                # The server is fine but rejected the workflow; another server would too
+                print(f"\n[!] ComfyUI rejected the prompt (HTTP {response.status_code}): {response.text[:200]}")
+                return None, None
+
+            try:
+                prompt_id = response.json().get('prompt_id')
+            except ValueError:
+                prompt_id = None
+            with self._lock:
+                target.submitted += 1
+                if prompt_id:
+                    target.our_ids.add(prompt_id)
+            return target, prompt_id
+
+    def upload_image(self, filepath, endpoint):
+        """Uploads an input image to one server and returns its stored name. The server counts
+        the upload towards its load until the job is submitted there (or released), so images
+        uploaded ahead of the queue spread across servers."""
+        try:
+            with open(filepath, 'rb') as f:
+                response = self.session.post(
+                    f"{endpoint.base_url}/upload/image",
+                    files={'image': f}, data={'overwrite': 'true'}, timeout=self.timeout
+                )
+            if response.status_code == 200:
+                name = response.json()['name']
+                with self._lock:
+                    endpoint.assigned += 1
+                return name
+            if response.status_code >= 500:
+                self.mark_down(endpoint, f"HTTP {response.status_code}")
+            else:
+                print(f"\n[!] {endpoint.base_url} rejected the upload (HTTP {response.status_code}): {response.text[:200]}")
+        except requests.exceptions.RequestException as e:
+            self.mark_down(endpoint, e)
+        except Exception as e:
+            print(f"\nFailed to upload image: {e}")
+        return None
@@ -0,0 +1,67 @@
+import json
+import os
+
+# =================================================================================
+#  SHARED COMFYUI WORKFLOW TEMPLATE
+#  Used by reimagine.py and Animateimageswithwan2.2.py so the workflow JSON is
+#  parsed and validated once per run instead of once per job.
+# =================================================================================
+
+class WorkflowError(Exception):
+    pass
+
+class WorkflowTemplate:
+    """A validated API-format workflow with named injection points.
+
+    injection_points maps a name to (node_id, input_name), e.g.
+    {"prompt": ("6", "text"), "seed": ("57", "seed")}.
+    """
+
+    def __init__(self, nodes, injection_points, source="workflow", strict=False):
+        if isinstance(nodes, list) or not isinstance(nodes, dict) or "nodes" in nodes:
+            raise WorkflowError(f"{source} is in 'Saved' format. Export it with 'Save (API Format)'.")
+
+        self.source = source
+        self._nodes = nodes
+        self.points = {}
+        self.missing = []
+        for name, (node_id, input_name) in injection_points.items():
+            node = nodes.get(node_id)
+            if not isinstance(node, dict) or not isinstance(node.get("inputs"), dict):
+                self.missing.append(name)
+                continue
+            self.points[name] = (node_id, input_name)
+
+        if strict and self.missing:
+            raise WorkflowError(f"{source} is missing nodes for: {', '.join(self.missing)}")
+
+    @classmethod
+    def load(cls, filename, injection_points, strict=False):
+        if not os.path.exists(filename):
+            raise WorkflowError(f"Workflow file '{filename}' not found.")
+        with open(filename, 'r', encoding='utf-8') as f:
+            try:
+                nodes = json.load(f)
+            except ValueError as e:
+                raise WorkflowError(f"{filename} is not valid JSON: {e}")
+        return cls(nodes, injection_points, source=filename, strict=strict)
+
+    def has(self, name):
+        return name in self.points
+
+    def render(self, **values):
+        """Builds a job payload. Only the patched nodes are copied; every other
+        node is shared with the template, so the result must be treated as read-only."""
+        payload = dict(self._nodes)
+        copied = set()
+        for name, value in values.items():
+            if name not in self.points:
+                continue  # Injection point absent from this workflow (see self.missing)
+            node_id, input_name = self.points[name]
+            if node_id not in copied:
+                node = dict(payload[node_id])
+                node["inputs"] = dict(node["inputs"])
+                payload[node_id] = node
+                copied.add(node_id)
+            payload[node_id]["inputs"][input_name] = value
+        return payload
@@ -0,0 +1,113 @@
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+
+# =================================================================================
+#  APPEND-ONLY COMPLETION JOURNAL
+#  One JSON record per line, appended and fsynced as each render finishes, so a
+#  crash loses at most the line being written. Lookups are a dict, so resume is
+#  O(1) per file instead of a list scan.
+# =================================================================================
+
+DEFAULT_JOURNAL_FILE = "completed_files.jsonl"
+
+class CompletionJournal:
+    def __init__(self, path=DEFAULT_JOURNAL_FILE, legacy_file=None):
+        self.path = path
+        self.records = {}  # filename -> most recent record
+        self._lock = threading.Lock()
+        self.skipped_lines = 0
+
+        if os.path.exists(path):
+            self._load()
+        elif legacy_file and os.path.exists(legacy_file):
+            self._import_legacy(legacy_file)
+
+    def _load(self):
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        for line in data.splitlines():
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                self.records[record["filename"]] = record
+            except (ValueError, KeyError, TypeError):
+                self.skipped_lines += 1  # Torn write from a crash; the render is simply redone
+        if data and not data.endswith(b'\n'):
+            # Terminate a torn last line so the next append starts on a fresh line
+            with open(self.path, 'ab') as f:
+                f.write(b'\n')
+
+    def _import_legacy(self, legacy_file):
+        """Seeds the journal from the old completed_files.json list."""
+        try:
+            with open(legacy_file, 'r') as f:
+                names = json.load(f)
+        except (OSError, ValueError):
+            return
+        records = [{"filename": name, "legacy": True} for name in names if isinstance(name, str)]
+        self._write_atomic(records)
+        for record in records:
+            self.records[record["filename"]] = record
+
+    def __contains__(self, filename):
+        return filename in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+    def add(self, filename, **fields):
+        """Appends a completion record (prompt_id, seed, prompt, output, ...) and syncs it to disk."""
+        record = {"filename": filename, "completed_at": time.strftime("%Y-%m-%d %H:%M:%S")}
+        record.update(fields)
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            self.records[filename] = record
+        return record
+
+    def _write_atomic(self, records):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def compact(self):
+        """Rewrites the journal with one record per file (the latest), atomically."""
+        with self._lock:
+            self._write_atomic(self.records.values())
+        return len(self.records)
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or compact a completion journal.")
+    parser.add_argument("command", choices=["stats", "list", "compact"])
+    parser.add_argument("--journal", default=DEFAULT_JOURNAL_FILE)
+    args = parser.parse_args()
+
+    if not os.path.exists(args.journal):
+        print(f"No journal found at {args.journal}")
+        sys.exit(1)
+
+    journal = CompletionJournal(args.journal)
+    if args.command == "stats":
+        print(f"{len(journal)} completed files in {args.journal}")
+        if journal.skipped_lines:
+            print(f"{journal.skipped_lines} unreadable line(s) ignored")
+    elif args.command == "list":
+        for record in journal.records.values():
+            print(json.dumps(record, ensure_ascii=False))
+    else:
+        print(f"Compacted {args.journal} to {journal.compact()} records")
+
+if __name__ == "__main__":
+    main()
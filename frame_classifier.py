@@ -0,0 +1,307 @@
+import os
+import sys
+import random
+import argparse
+import threading
+import cv2
+import numpy as np
+
+# =================================================================================
+#  LOCAL FRAME PRE-CLASSIFIER
+#  A CPU-only first pass for the screenshot sorter. Frames become a feature vector
+#  (colour histogram, gradient-orientation grid, skin-tone coverage, tiny
+#  thumbnail) or, when onnxruntime and an image-embedding model are available,
+#  that model's embedding. A softmax head trained with NumPy on the frames the
+#  sorter already filed into its category folders turns it into a label and a
+#  confidence. Everything runs offline; nothing here talks to LM Studio.
+#
+#  python frame_classifier.py train [--root .] [--onnx clip_visual.onnx]
+#  python frame_classifier.py evaluate [--root .]
+# =================================================================================
+
+DEFAULT_MODEL_FILE = "frame_classifier.npz"
+
+# Same folders the sorter writes to; label -> folder
+DEFAULT_DIRS = {
+    "Adult Male": "Adult_Male",
+    "Adult Female": "Adult_Female",
+    "Child": "Child",
+    "Animal": "Animal",
+    "None": "No_Prominent_Character"
+}
+
+# Reply phrase -> label, checked in this order; a reply matching none is "None"
+REPLY_PHRASES = (
+    ("adult male", "Adult Male"),
+    ("adult female", "Adult Female"),
+    ("child", "Child"),
+    ("animal", "Animal"),
+)
+
+# Files the pre-classifier sorted on its own carry this suffix and are left out of
+# training, so the head never learns from its own guesses
+AUTO_SUFFIX = "_auto"
+
+VALID_EXTS = ('.jpg', '.jpeg', '.png', '.webp')
+
+def category_for(reply):
+    """The label an LLM reply (e.g. "Category: Adult Female.") is sorted under."""
+    text = reply.lower()
+    for phrase, label in REPLY_PHRASES:
+        if phrase in text:
+            return label
+    return "None"
+
+def handcrafted_features(frame):
+    """Fixed-length float32 features of a BGR frame; about a millisecond at 128x128."""
+    small = cv2.resize(frame, (128, 128), interpolation=cv2.INTER_AREA)
+
+    hsv = cv2.cvtColor(small, cv2.COLOR_BGR2HSV)
+    color = cv2.calcHist([hsv], [0, 1], None, [12, 4], [0, 180, 0, 256]).flatten()
+    color /= max(color.sum(), 1.0)
+
+    # HOG-style: 4x4 cells x 8 unsigned orientation bins, weighted by gradient magnitude
+    gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY).astype(np.float32)
+    gx = cv2.Sobel(gray, cv2.CV_32F, 1, 0)
+    gy = cv2.Sobel(gray, cv2.CV_32F, 0, 1)
+    magnitude, angle = cv2.cartToPolar(gx, gy, angleInDegrees=True)
+    orientation = np.minimum(((angle % 180) / 22.5).astype(np.int64), 7)
+    cell = (np.arange(128) // 32)
+    index = (cell[:, None] * 4 + cell[None, :]) * 8 + orientation
+    gradients = np.bincount(index.ravel(), weights=magnitude.ravel(), minlength=128).astype(np.float32)
+    gradients /= max(float(np.linalg.norm(gradients)), 1e-6)
+
+    # Skin-tone coverage, overall and in the centre where the focal character usually is
+    ycrcb = cv2.cvtColor(small, cv2.COLOR_BGR2YCrCb)
+    skin = cv2.inRange(ycrcb, (0, 133, 77), (255, 173, 127)) > 0
+    skin_cover = np.array([skin.mean(), skin[32:96, 32:96].mean()], dtype=np.float32)
+
+    thumb = cv2.resize(gray, (8, 8), interpolation=cv2.INTER_AREA).ravel()
+    thumb = (thumb - thumb.mean()) / (thumb.std() + 1e-6)
+
+    return np.concatenate([color, gradients, skin_cover, thumb.astype(np.float32)])
+
+class OnnxEmbedder:
+    """Image embeddings from a CLIP-style ONNX vision model (224x224 RGB in, one vector out)."""
+
+    MEAN = np.array([0.48145466, 0.4578275, 0.40821073], dtype=np.float32)
+    STD = np.array([0.26862954, 0.26130258, 0.27577711], dtype=np.float32)
+
+    def __init__(self, model_path):
+        import onnxruntime  # Optional dependency, only needed for embedding features
+        self.name = os.path.basename(model_path)
+        self.session = onnxruntime.InferenceSession(model_path, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+        self._lock = threading.Lock()
+
+    def __call__(self, frame):
+        rgb = cv2.cvtColor(cv2.resize(frame, (224, 224), interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2RGB)
+        x = ((rgb.astype(np.float32) / 255.0 - self.MEAN) / self.STD).transpose(2, 0, 1)[None]
+        with self._lock:
+            out = self.session.run(None, {self.input_name: x})[0]
+        vec = np.asarray(out, dtype=np.float32).ravel()
+        return vec / max(float(np.linalg.norm(vec)), 1e-6)
+
+def _softmax(z):
+    z = z - z.max(axis=1, keepdims=True)
+    e = np.exp(z)
+    return e / e.sum(axis=1, keepdims=True)
+
+class FrameClassifier:
+    def __init__(self, labels, weights, bias, mean, std, feature_kind="handcrafted", embedder=None):
+        self.labels = list(labels)
+        self.weights = weights
+        self.bias = bias
+        self.mean = mean
+        self.std = std
+        self.feature_kind = feature_kind
+        self.embedder = embedder
+
+    def features(self, frame):
+        return self.embedder(frame) if self.embedder is not None else handcrafted_features(frame)
+
+    def predict_proba(self, features):
+        x = (np.atleast_2d(features) - self.mean) / self.std
+        return _softmax(x @ self.weights + self.bias)
+
+    def predict(self, img_bytes):
+        """(label, confidence) for JPEG/PNG bytes, or (None, 0.0) if they don't decode."""
+        frame = cv2.imdecode(np.frombuffer(img_bytes, np.uint8), cv2.IMREAD_COLOR)
+        if frame is None:
+            return None, 0.0
+        probs = self.predict_proba(self.features(frame))[0]
+        best = int(np.argmax(probs))
+        return self.labels[best], float(probs[best])
+
+    @classmethod
+    def train(cls, features, targets, labels, feature_kind="handcrafted", embedder=None,
+              epochs=400, learning_rate=0.5, l2=1e-3):
+        """Multinomial logistic regression, full-batch gradient descent on standardized features."""
+        features = np.asarray(features, dtype=np.float32)
+        targets = np.asarray(targets, dtype=np.int64)
+        mean = features.mean(axis=0)
+        std = features.std(axis=0) + 1e-6
+        x = (features - mean) / std
+        onehot = np.eye(len(labels), dtype=np.float32)[targets]
+        # Inverse-frequency weights so "None" (usually the biggest folder) doesn't swamp the rest
+        counts = np.maximum(onehot.sum(axis=0), 1.0)
+        sample_weight = (len(targets) / (len(labels) * counts))[targets][:, None]
+
+        weights = np.zeros((x.shape[1], len(labels)), dtype=np.float32)
+        bias = np.zeros(len(labels), dtype=np.float32)
+        for _ in range(epochs):
+            grad = (_softmax(x @ weights + bias) - onehot) * sample_weight / len(x)
+            weights -= learning_rate * (x.T @ grad + l2 * weights)
+            bias -= learning_rate * grad.sum(axis=0)
+        return cls(labels, weights, bias, mean, std, feature_kind, embedder)
+
+    def save(self, path=DEFAULT_MODEL_FILE):
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(tmp_path, labels=np.array(self.labels), weights=self.weights, bias=self.bias,
+                 mean=self.mean, std=self.std, feature_kind=np.array(self.feature_kind))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path=DEFAULT_MODEL_FILE, embedder=None):
+        """Raises ValueError when the saved head was trained on different features than `embedder` gives."""
+        data = np.load(path)
+        feature_kind = str(data["feature_kind"])
+        expected = embedder.name if embedder is not None else "handcrafted"
+        if feature_kind != expected:
+            raise ValueError(f"{path} was trained on '{feature_kind}' features, not '{expected}'")
+        return cls([str(l) for l in data["labels"]], data["weights"], data["bias"],
+                   data["mean"], data["std"], feature_kind, embedder)
+
+def labeled_files(root=".", dirs=DEFAULT_DIRS):
+    """(path, label) for every sorted frame under the category folders, minus pre-classified ones."""
+    files = []
+    for label, folder in dirs.items():
+        folder = os.path.join(root, folder)
+        if not os.path.isdir(folder):
+            continue
+        for name in os.listdir(folder):
+            stem, ext = os.path.splitext(name)
+            if ext.lower() in VALID_EXTS and not stem.endswith(AUTO_SUFFIX):
+                files.append((os.path.join(folder, name), label))
+    return files
+
+def featurize(files, labels, embedder=None):
+    feats, targets = [], []
+    for path, label in files:
+        frame = cv2.imread(path, cv2.IMREAD_COLOR)
+        if frame is None:
+            continue
+        feats.append(embedder(frame) if embedder is not None else handcrafted_features(frame))
+        targets.append(labels.index(label))
+    return np.array(feats, dtype=np.float32), np.array(targets, dtype=np.int64)
+
+def shuffled_features(root=".", dirs=DEFAULT_DIRS, embedder=None, seed=0):
+    """Features and targets of the sorted frames in a seeded order, so train and evaluate split alike."""
+    files = labeled_files(root, dirs)
+    random.Random(seed).shuffle(files)
+    return featurize(files, list(dirs), embedder)
+
+def holdout_predictions(feats, targets, labels, embedder=None, holdout=0.2):
+    """(probabilities, targets) on the last `holdout` share, from a head fitted on the rest; None if too few."""
+    split = int(len(feats) * (1 - holdout))
+    if not holdout or not 0 < split < len(feats):
+        return None
+    feature_kind = embedder.name if embedder is not None else "handcrafted"
+    probe = FrameClassifier.train(feats[:split], targets[:split], labels, feature_kind, embedder)
+    return probe.predict_proba(feats[split:]), targets[split:]
+
+def train_from_folders(root=".", dirs=DEFAULT_DIRS, embedder=None, holdout=0.2, seed=0):
+    """Trains on the sorter's past output. Returns (classifier, holdout accuracy or None, frames used)."""
+    labels = list(dirs)
+    feats, targets = shuffled_features(root, dirs, embedder, seed)
+    if not len(feats):
+        return None, None, 0
+    feature_kind = embedder.name if embedder is not None else "handcrafted"
+
+    accuracy = None
+    held_out = holdout_predictions(feats, targets, labels, embedder, holdout)
+    if held_out is not None:
+        probs, held_targets = held_out
+        accuracy = float((probs.argmax(axis=1) == held_targets).mean())
+    # The kept model sees every example
+    return FrameClassifier.train(feats, targets, labels, feature_kind, embedder), accuracy, len(feats)
+
+class AgreementLog:
+    """Local-vs-LLM agreement on frames both looked at, by local confidence, for tuning the threshold."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.pairs = []  # (confidence, agreed)
+
+    def record(self, confidence, local_label, llm_label):
+        # Mapped the way the sorter files it, so wording around the category isn't a disagreement
+        agreed = local_label is not None and local_label == category_for(llm_label)
+        with self._lock:
+            self.pairs.append((confidence, agreed))
+        return agreed
+
+    def report(self, thresholds=(0.5, 0.6, 0.7, 0.8, 0.9, 0.95)):
+        with self._lock:
+            pairs = list(self.pairs)
+        if not pairs:
+            return "Pre-classifier agreement: no frames compared"
+        agreed = sum(1 for _, a in pairs if a)
+        lines = [f"Pre-classifier agreement with the LLM: {agreed}/{len(pairs)} ({agreed / len(pairs):.0%})",
+                 f"{'confidence >=':>14} {'frames':>7} {'agree':>7}"]
+        for t in thresholds:
+            above = [a for c, a in pairs if c >= t]
+            if above:
+                lines.append(f"{t:>14.2f} {len(above):>7} {sum(above) / len(above):>7.0%}")
+        return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description="Train or evaluate the screenshot sorter's local pre-classifier.")
+    parser.add_argument("command", choices=["train", "evaluate"])
+    parser.add_argument("--root", default=".", help="Folder holding the sorter's category folders")
+    parser.add_argument("--model", default=DEFAULT_MODEL_FILE)
+    parser.add_argument("--onnx", help="CLIP-style ONNX vision model for embedding features (needs onnxruntime)")
+    args = parser.parse_args()
+
+    embedder = None
+    if args.onnx:
+        try:
+            embedder = OnnxEmbedder(args.onnx)
+        except Exception as e:
+            print(f"[!] Could not load {args.onnx}: {e}")
+            sys.exit(1)
+
+    if args.command == "train":
+        classifier, accuracy, used = train_from_folders(args.root, embedder=embedder)
+        if classifier is None:
+            print(f"No sorted frames found under {os.path.abspath(args.root)}")
+            sys.exit(1)
+        classifier.save(args.model)
+        held_out = f", holdout accuracy {accuracy:.1%}" if accuracy is not None else ""
+        print(f"Trained on {used} frames ({classifier.feature_kind} features){held_out} -> {args.model}")
+        return
+
+    if not os.path.exists(args.model):
+        print(f"No model found at {args.model}")
+        sys.exit(1)
+    try:
+        classifier = FrameClassifier.load(args.model, embedder)
+    except ValueError as e:
+        print(f"[!] {e}")
+        sys.exit(1)
+    # The saved head was fitted on every sorted frame, so scoring it on them would only show
+    # training accuracy; instead refit on the same split train used and score the held-out part
+    dirs = {label: DEFAULT_DIRS.get(label, label) for label in classifier.labels}
+    feats, targets = shuffled_features(args.root, dirs, embedder)
+    held_out = holdout_predictions(feats, targets, classifier.labels, embedder)
+    if held_out is None:
+        print("Not enough sorted frames for a holdout split.")
+        sys.exit(1)
+    probs, held_targets = held_out
+    log = AgreementLog()
+    for p, t in zip(probs, held_targets):
+        log.record(float(p.max()), classifier.labels[int(p.argmax())], classifier.labels[int(t)])
+    print(f"Holdout: {len(held_targets)} of {len(targets)} sorted frames, head fitted on the rest")
+    print(log.report().replace("with the LLM", "with the folder labels"))
+
+if __name__ == "__main__":
+    main()
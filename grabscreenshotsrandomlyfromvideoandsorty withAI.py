@@ -6,18 +6,106 @@ os.environ["OPENCV_VIDEOIO_DEBUG"] = "0"
 
 import cv2
 import random
+import numpy as np
 import shutil
 import base64
-import requests
 import signal
 import sys
+import re
+import time
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
+from video_probe import ProbeCache, find_ffmpeg, find_ffprobe
+from prompt_cache import make_prompt_key
+from phash_index import PerceptualIndex, dhash
+from lm_client import VisionClient, LMError, images_message
+from pipeline_metrics import Metrics
+from frame_classifier import FrameClassifier, OnnxEmbedder, AgreementLog, train_from_folders, labeled_files, category_for, AUTO_SUFFIX
 
 # ================= CONFIGURATION =================
 LM_STUDIO_URL = "http://192.168.2.192:1234/v1/chat/completions"
 MODEL_ID = "qwen/qwen3-vl-8b"
 VIDEO_EXTS = ('.mp4', '.mkv', '.avi', '.mov', '.wmv', '.flv')
 
+# Video metadata (fps, frame count, ...) is cached by path + size + mtime across runs
+PROBE_CACHE_FILE = "video_probe_cache.db"
+PROBE_WORKERS = os.cpu_count() or 4
+
+# Frames closer than this after the previous one are reached by grabbing (decode-only)
+# instead of seeking; seeks in long MKVs are far more expensive than a few grabs
+MAX_GRAB_GAP = 250
+
+# Pipeline: decode processes -> bounded frame queue -> classifier threads -> one sorter
+DECODE_WORKERS = max(1, (os.cpu_count() or 2) // 2)  # OpenCV decode processes
+CLASSIFY_WORKERS = 4                                  # Concurrent LM Studio requests
+LM_TIMEOUT = 30
+LM_MAX_RETRIES = 2                                    # Jittered backoff on timeouts/5xx
+FRAME_QUEUE_SIZE = 16                                 # Decoded frames waiting for the LLM
+
+# Several frames per LLM request: one prompt prefill and round trip for K answers.
+# A reply that doesn't name a valid category for every frame falls back to one request per frame.
+CLASSIFY_BATCH_SIZE = 4     # K; 1 sends every frame on its own
+BATCH_LAYOUT = "images"     # "images": K images in one message; "grid": one labeled tile image (single-image models)
+BATCH_WAIT = 0.5            # Seconds a classifier waits to fill a batch before sending what it has
+GRID_TILE_WIDTH = 512       # Tile size in "grid" layout (16:9 cells)
+
+# Near-duplicate frames (static shots, repeats across re-encodes) reuse an earlier classification
+ENABLE_PHASH = True
+PHASH_FILE = "phash_index.db"
+PHASH_MAX_DISTANCE = 4      # Differing bits (of 64) that still count as the same picture
+NEAR_DUP_ACTION = "reuse"   # "reuse" the earlier classification, or "skip" the frame
+
+# Cheap frame-quality prefilter: black/white fades, flat title cards, motion blur and frames
+# sitting on a scene cut are rejected before the LLM sees them, and a nearby frame is tried
+ENABLE_QUALITY_FILTER = True
+MIN_BRIGHTNESS = 20         # Mean luma (0-255) below this is a black frame or fade
+MAX_BRIGHTNESS = 235        # ...above this a white flash or fade to white
+MIN_CONTRAST = 12           # Luma std dev; fades and flat cards are low
+MAX_FLAT_FRACTION = 0.9     # Share of pixels within +-10 of the median; title cards on a flat background
+MIN_SHARPNESS = 40.0        # Variance of the Laplacian at QUALITY_WIDTH; motion blur scores low
+SCENE_CUT_THRESHOLD = 0.3   # Histogram change (0-1) from BOTH neighbours CUT_WINDOW frames away; above =
+                            # a blended transition frame (the first frame of a new shot matches the next one)
+CUT_WINDOW = 3              # Frames
+QUALITY_WIDTH = 320         # Frames are measured at this width
+MAX_RESAMPLES = 3           # Nearby frames tried after a rejection before the sample is dropped
+RESAMPLE_STEP_SEC = 1.0     # Each retry moves this far forward in the same open capture
+
+# Optional local CPU pre-classifier (frame_classifier.py): frames it is confident about are sorted
+# without an LLM call. It is trained from frames already sorted into DIRS and runs fully offline.
+ENABLE_PRECLASSIFIER = False
+PRECLASSIFIER_FILE = "frame_classifier.npz"
+PRECLASSIFIER_ONNX = None       # CLIP-style ONNX vision model for embedding features (needs onnxruntime)
+PRECLASSIFY_THRESHOLD = 0.85    # Local confidence needed to skip the LLM
+PRECLASSIFY_AUDIT_RATE = 0.05   # Share of confident frames still sent to the LLM, to keep measuring agreement
+MIN_TRAINING_FRAMES = 200       # With no saved model, train one at startup once this many sorted frames exist
+
+METRICS_FILE = "sorter_metrics.jsonl"   # Per-frame stage timings (None to disable)
+METRICS_PROM_FILE = None                # e.g. a node_exporter textfile-collector path ending in .prom
+
+CLASSIFY_PROMPT = (
+    "Analyze the single most prominent character in this image. "
+    "Classify them into exactly ONE of these categories: "
+    "'Adult Male', 'Adult Female', 'Child', 'Animal', or 'None'. "
+    "Rules: "
+    "1. If the character is human and under ~13 years old, choose 'Child'. "
+    "2. If the character is a non-human creature, choose 'Animal'. "
+    "3. If there is an ensemble cast or no clear focal point, choose 'None'. "
+    "Respond with the category name only."
+)
+
+BATCH_CLASSIFY_PROMPT = (
+    "You are given {n} images, numbered 1 to {n} in the order they appear{layout}. "
+    "For EACH image, analyze the single most prominent character and classify them into exactly ONE of "
+    "these categories: 'Adult Male', 'Adult Female', 'Child', 'Animal', or 'None'. "
+    "Rules: "
+    "1. If the character is human and under ~13 years old, choose 'Child'. "
+    "2. If the character is a non-human creature, choose 'Animal'. "
+    "3. If there is an ensemble cast or no clear focal point, choose 'None'. "
+    "Respond with exactly {n} lines in the form '<number>: <category>' and nothing else."
+)
+
 DIRS = {
     "Adult Male": "Adult_Male",
     "Adult Female": "Adult_Female",
@@ -37,7 +125,7 @@ except AttributeError:
 
 def signal_handler(sig, frame):
     global exit_requested
-    print("\n[!] Exit requested. Finishing current frame and closing...")
+    print("\n[!] Exit requested. Finishing in-flight frames and closing...")
     exit_requested = True
 
 # Register Ctrl+C as a clean exit hotkey
@@ -45,6 +133,40 @@ signal.signal(signal.SIGINT, signal_handler)
 
 # ================= CORE FUNCTIONS =================
 
+# Shared by the classifier threads: pooled keep-alive connections, retries, latency stats
+metrics = Metrics("sorter", METRICS_FILE, METRICS_PROM_FILE)
+lm = VisionClient(LM_STUDIO_URL, MODEL_ID, timeout=LM_TIMEOUT,
+                  max_concurrency=CLASSIFY_WORKERS, max_retries=LM_MAX_RETRIES, metrics=metrics)
+
+# Set up by main() when ENABLE_PRECLASSIFIER is on
+preclassifier = None
+agreement = AgreementLog()
+
+def load_preclassifier():
+    """The saved local classifier, or one trained now from past sorter output; None if neither works."""
+    try:
+        embedder = OnnxEmbedder(PRECLASSIFIER_ONNX) if PRECLASSIFIER_ONNX else None
+    except Exception as e:
+        print(f"[!] Could not load {PRECLASSIFIER_ONNX}: {e}. Pre-classifier disabled.")
+        return None
+    if os.path.exists(PRECLASSIFIER_FILE):
+        try:
+            return FrameClassifier.load(PRECLASSIFIER_FILE, embedder)
+        except (ValueError, OSError, KeyError) as e:
+            print(f"[!] {e}. Retraining.")
+    available = len(labeled_files(".", DIRS))
+    if available < MIN_TRAINING_FRAMES:
+        print(f"Pre-classifier: only {available} sorted frames to learn from (need {MIN_TRAINING_FRAMES}), using the LLM for everything.")
+        return None
+    print(f"Training pre-classifier on {available} sorted frames...")
+    classifier, accuracy, used = train_from_folders(".", DIRS, embedder)
+    if classifier is None:
+        return None
+    classifier.save(PRECLASSIFIER_FILE)
+    if accuracy is not None:
+        print(f"Pre-classifier holdout accuracy: {accuracy:.1%}")
+    return classifier
+
 def encode_image(image_bytes):
     """Encodes raw image bytes to base64 for the API."""
     return base64.b64encode(image_bytes).decode('utf-8')
@@ -52,33 +174,11 @@ def encode_image(image_bytes):
 def classify_frame(image_bytes):
     """Sends the extracted frame to LM Studio for classification."""
     base64_image = encode_image(image_bytes)
-    
-    prompt_text = (
-        "Analyze the single most prominent character in this image. "
-        "Classify them into exactly ONE of these categories: "
-        "'Adult Male', 'Adult Female', 'Child', 'Animal', or 'None'. "
-        "Rules: "
-        "1. If the character is human and under ~13 years old, choose 'Child'. "
-        "2. If the character is a non-human creature, choose 'Animal'. "
-        "3. If there is an ensemble cast or no clear focal point, choose 'None'. "
-        "Respond with the category name only."
-    )
-
-    payload = {
-        "model": MODEL_ID,
-        "messages": [{"role": "user", "content": [
-            {"type": "text", "text": prompt_text},
-            {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}}
-        ]}],
-        "temperature": 0.1, 
-        "max_tokens": 15
-    }
 
     try:
-        response = requests.post(LM_STUDIO_URL, json=payload, timeout=30)
-        response.raise_for_status()
-        return response.json()['choices'][0]['message']['content'].strip().strip(".").strip()
-    except Exception as e:
+        content = lm.describe(CLASSIFY_PROMPT, base64_image, temperature=0.1, max_tokens=15)
+        return content.strip(".").strip()
+    except LMError as e:
         return f"Error: {e}"
 
 def get_valid_frame_index(cap, fps, total_frames):
@@ -100,6 +200,389 @@ def get_valid_frame_index(cap, fps, total_frames):
         
     return random.randint(start_f, end_f)
 
+def plan_samples(video_files, num_to_extract):
+    """Decides up front how many frames come from each video.
+    Same rule as picking one at a time: every video is used once before any repeats."""
+    plan = {}
+    pool = []
+    for _ in range(num_to_extract):
+        # Refill pool if empty to ensure every video is picked before repeating
+        if not pool:
+            pool = video_files.copy()
+            random.shuffle(pool)
+        video_path = pool.pop()
+        plan[video_path] = plan.get(video_path, 0) + 1
+    return plan
+
+def pick_frame_indices(fps, total_frames, count):
+    """Draws `count` distinct frame indices with get_valid_frame_index, sorted for forward reads."""
+    indices = set()
+    for _ in range(count * 10):
+        if len(indices) >= count:
+            break
+        indices.add(min(get_valid_frame_index(None, fps, total_frames), total_frames - 1))
+    return sorted(indices)
+
+def read_video_meta(cap):
+    """fps/frame count as reported by OpenCV, for videos the probe cache doesn't know."""
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    if fps <= 0 or total_frames <= 0:
+        return None
+    return {
+        "width": int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+        "height": int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+        "fps": fps, "frame_count": total_frames, "duration": total_frames / fps,
+        "partial": True,
+    }
+
+def quality_gray(frame):
+    """Downscaled grayscale copy the quality checks run on."""
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    h, w = gray.shape
+    if w > QUALITY_WIDTH:
+        gray = cv2.resize(gray, (QUALITY_WIDTH, max(1, h * QUALITY_WIDTH // w)), interpolation=cv2.INTER_AREA)
+    return gray
+
+def scene_change(gray_a, gray_b):
+    """0 for the same shot, towards 1 for unrelated pictures (32-bin luma histogram correlation)."""
+    hist_a = cv2.calcHist([gray_a], [0], None, [32], [0, 256])
+    hist_b = cv2.calcHist([gray_b], [0], None, [32], [0, 256])
+    return float(np.clip(1.0 - cv2.compareHist(hist_a, hist_b, cv2.HISTCMP_CORREL), 0.0, 1.0))
+
+def reject_reason(gray, previous_gray=None, next_gray=None):
+    """Why a frame isn't worth an LLM call ("dark", "bright", "flat", "blurry", "scene_cut"), or None.
+    A frame is only on a cut when it resembles neither neighbour, so clean shot boundaries pass."""
+    mean, std = cv2.meanStdDev(gray)
+    brightness, contrast = float(mean[0][0]), float(std[0][0])
+    if brightness < MIN_BRIGHTNESS:
+        return "dark"
+    if brightness > MAX_BRIGHTNESS:
+        return "bright"
+    if contrast < MIN_CONTRAST:
+        return "flat"
+    if np.mean(np.abs(gray.astype(np.int16) - int(np.median(gray))) <= 10) > MAX_FLAT_FRACTION:
+        return "flat"
+    if cv2.Laplacian(gray, cv2.CV_64F).var() < MIN_SHARPNESS:
+        return "blurry"
+    if previous_gray is not None and next_gray is not None \
+            and min(scene_change(previous_gray, gray), scene_change(gray, next_gray)) > SCENE_CUT_THRESHOLD:
+        return "scene_cut"
+    return None
+
+def read_frame_at(cap, frame_idx, position):
+    """Reads frame_idx from an open capture whose next read() returns `position`.
+    Returns (frame or None, new position)."""
+    gap = frame_idx - position
+    if 0 <= gap <= MAX_GRAB_GAP:
+        # Close ahead: grab() advances without decoding to RGB, cheaper than a seek
+        for _ in range(gap):
+            if not cap.grab():
+                break
+    else:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
+    success, frame = cap.read()
+    return (frame if success else None), frame_idx + 1
+
+def extract_frames(cap, fps, total_frames, count, quality=None):
+    """Yields (frame_idx, frame, gray) for `count` sampled frames in file order, from an open capture.
+    frame is None when a read fails or no candidate passed the quality filter. `quality`, if given,
+    collects {"rejected": {reason: n}, "dropped": samples with no usable candidate}."""
+    position = 0  # Index of the frame the next read() returns
+    step = max(1, int(round(fps * RESAMPLE_STEP_SEC)))
+    for frame_idx in pick_frame_indices(fps, total_frames, count):
+        if not ENABLE_QUALITY_FILTER:
+            frame, position = read_frame_at(cap, frame_idx, position)
+            yield frame_idx, frame, (quality_gray(frame) if frame is not None else None)
+            continue
+
+        candidate, chosen, gray, rejected = frame_idx, None, None, False
+        for _ in range(MAX_RESAMPLES + 1):
+            if candidate >= total_frames:
+                break
+            # Neighbours a few frames either side, in the same forward decode run; almost free
+            # compared to the LLM
+            previous_gray = next_gray = None
+            if candidate >= CUT_WINDOW:
+                previous, position = read_frame_at(cap, candidate - CUT_WINDOW, position)
+                previous_gray = quality_gray(previous) if previous is not None else None
+            frame, position = read_frame_at(cap, candidate, position)
+            if frame is None:
+                break
+            if candidate + CUT_WINDOW < total_frames:
+                following, position = read_frame_at(cap, candidate + CUT_WINDOW, position)
+                next_gray = quality_gray(following) if following is not None else None
+            gray = quality_gray(frame)
+            reason = reject_reason(gray, previous_gray, next_gray)
+            if reason is None:
+                chosen = frame
+                break
+            rejected = True
+            if quality is not None:
+                quality["rejected"][reason] = quality["rejected"].get(reason, 0) + 1
+            candidate += step
+        if chosen is None and rejected and quality is not None:
+            quality["dropped"] += 1
+        yield candidate, chosen, (gray if chosen is not None else None)
+
+def init_decode_worker():
+    # Ctrl+C is handled by the main process, which drains the pipeline itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def decode_video(video_path, count, info):
+    """Decode-stage task (runs in a worker process): one open, all sampled frames as JPEG bytes.
+    Returns (info, [(frame_idx, jpg_bytes or None, phash or None)], quality stats, error)."""
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        return None, [], {}, f"Failed to open {video_path}"
+    try:
+        if info is None:
+            info = read_video_meta(cap)
+            if info is None:
+                return None, [], {}, None
+        frames = []
+        quality = {"rejected": {}, "dropped": 0}
+        for frame_idx, frame, gray in extract_frames(cap, info["fps"], info["frame_count"], count, quality):
+            img_bytes, phash = None, None
+            if frame is not None:
+                # Convert frame to jpg in memory
+                ok, buffer = cv2.imencode('.jpg', frame)
+                img_bytes = buffer.tobytes() if ok else None
+                phash = dhash(cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA))
+            frames.append((frame_idx, img_bytes, phash))
+        return info, frames, quality, None
+    finally:
+        cap.release()
+
+def sort_frame(video_path, frame_idx, fps, img_bytes, raw_result, suffix=""):
+    """Writes a classified frame into its category folder and returns the file name."""
+    # Sorting Logic (shared with the pre-classifier's agreement check)
+    target_folder = DIRS[category_for(raw_result)]
+
+    # File Naming: [Original]_[Timestamp]_[FrameID].jpg
+    filename_slug = os.path.splitext(os.path.basename(video_path))[0]
+    timestamp_sec = int(frame_idx / fps)
+    out_name = f"{filename_slug}_T{timestamp_sec}s_F{frame_idx}{suffix}.jpg"
+    out_path = os.path.join(target_folder, out_name)
+
+    with open(out_path, "wb") as f:
+        f.write(img_bytes)
+    return out_name
+
+_STAGE_DONE = None
+
+def tile_grid(images):
+    """One JPEG with the frames letterboxed into numbered 16:9 cells, left to right, top to bottom."""
+    cell_w, cell_h = GRID_TILE_WIDTH, GRID_TILE_WIDTH * 9 // 16
+    cols = int(np.ceil(np.sqrt(len(images))))
+    rows = int(np.ceil(len(images) / cols))
+    grid = np.zeros((rows * cell_h, cols * cell_w, 3), dtype=np.uint8)
+    for n, img_bytes in enumerate(images):
+        frame = cv2.imdecode(np.frombuffer(img_bytes, np.uint8), cv2.IMREAD_COLOR)
+        y, x = (n // cols) * cell_h, (n % cols) * cell_w
+        if frame is not None:
+            scale = min(cell_w / frame.shape[1], cell_h / frame.shape[0])
+            w, h = max(1, int(frame.shape[1] * scale)), max(1, int(frame.shape[0] * scale))
+            oy, ox = y + (cell_h - h) // 2, x + (cell_w - w) // 2
+            grid[oy:oy + h, ox:ox + w] = cv2.resize(frame, (w, h), interpolation=cv2.INTER_AREA)
+        for color, thickness in (((0, 0, 0), 6), ((255, 255, 255), 2)):
+            cv2.putText(grid, str(n + 1), (x + 10, y + 40), cv2.FONT_HERSHEY_SIMPLEX, 1.2, color, thickness)
+    ok, buffer = cv2.imencode('.jpg', grid)
+    return buffer.tobytes()
+
+def parse_batch_reply(content, n):
+    """Maps '<number>: <category>' lines to one category per frame, or None unless every frame
+    1..n got exactly one valid category."""
+    categories = {name.lower(): name for name in DIRS}
+    answers = {}
+    for line in content.splitlines():
+        match = re.match(r"^\W*(?:image|frame|tile)?\s*#?(\d+)\s*[:.)\-]+\s*(.+?)\W*$", line.strip(), re.IGNORECASE)
+        if not match:
+            continue
+        index, label = int(match.group(1)), categories.get(match.group(2).strip(" '\"*").lower())
+        if label is None or not 1 <= index <= n or index in answers:
+            return None
+        answers[index] = label
+    if len(answers) != n:
+        return None
+    return [answers[i] for i in range(1, n + 1)]
+
+def classify_batch(images):
+    """One classification per frame, from a single request when there are several frames."""
+    if len(images) == 1:
+        return [classify_frame(images[0])]
+    params = {"temperature": 0.1, "max_tokens": 15 * len(images)}
+    try:
+        if BATCH_LAYOUT == "grid":
+            prompt = BATCH_CLASSIFY_PROMPT.format(n=len(images), layout=" as numbered tiles of one grid, left to right, top to bottom")
+            content = lm.describe(prompt, encode_image(tile_grid(images)), **params)
+        else:
+            prompt = BATCH_CLASSIFY_PROMPT.format(n=len(images), layout="")
+            content = lm.chat([images_message(prompt, [encode_image(b) for b in images])], **params)
+    except LMError as e:
+        return [f"Error: {e}"] * len(images)
+    results = parse_batch_reply(content, len(images))
+    if results is None:
+        # Unusable reply: ask about each frame on its own rather than guess
+        metrics.count("batch_fallbacks")
+        results = [classify_frame(b) for b in images]
+    return results
+
+def classify_items(items, near_dups):
+    """(classification, local) per queued frame, in order; a None classification drops the frame and
+    local marks the pre-classifier's own answers. Near-duplicates reuse an earlier result, confident
+    local guesses are kept, the rest go to the LLM together."""
+    results = [None] * len(items)
+    local = [False] * len(items)
+    guesses = {}  # item index -> (label, confidence) for frames the LLM also sees
+    todo = []
+    for i, (video_path, frame_idx, fps, img_bytes, phash) in enumerate(items):
+        if img_bytes is None:
+            continue
+        if near_dups is not None and phash is not None:
+            match = near_dups.find(phash)
+            if match:
+                metrics.count("near_duplicates")
+                if NEAR_DUP_ACTION != "skip":
+                    results[i] = match[0]
+                continue
+        if preclassifier is not None:
+            with metrics.span("preclassify"):
+                label, confidence = preclassifier.predict(img_bytes)
+            if label is not None and confidence >= PRECLASSIFY_THRESHOLD and random.random() >= PRECLASSIFY_AUDIT_RATE:
+                metrics.count("preclassified")
+                results[i], local[i] = label, True
+                continue
+            guesses[i] = (label, confidence)
+        todo.append(i)
+    if not todo:
+        return list(zip(results, local))
+
+    with metrics.span("classify", frames=len(todo)):
+        raw_results = classify_batch([items[i][3] for i in todo])
+    for i, raw_result in zip(todo, raw_results):
+        results[i] = raw_result
+        video_path, frame_idx, _, _, phash = items[i]
+        if raw_result.startswith("Error:"):
+            continue
+        if near_dups is not None and phash is not None:
+            near_dups.add(phash, raw_result, f"{video_path}#{frame_idx}")
+        if i in guesses:
+            label, confidence = guesses[i]
+            agreed = agreement.record(confidence, label, raw_result)
+            metrics.record("preclassify_check", 0.0, f"{video_path}#{frame_idx}", local=label,
+                           confidence=round(confidence, 3), llm=raw_result, agreed=agreed)
+    return list(zip(results, local))
+
+def next_batch(frame_queue):
+    """Up to CLASSIFY_BATCH_SIZE queued frames, waiting at most BATCH_WAIT after the first.
+    Returns (items, finished) where finished means the end-of-stage marker was taken."""
+    items, deadline = [], None
+    while len(items) < max(1, CLASSIFY_BATCH_SIZE) and not exit_requested:
+        timeout = 0.2 if deadline is None else deadline - time.monotonic()
+        try:
+            item = frame_queue.get(timeout=timeout) if timeout > 0 else frame_queue.get_nowait()
+        except queue.Empty:
+            if items:
+                break
+            continue
+        if item is _STAGE_DONE:
+            return items, True
+        items.append(item)
+        if deadline is None:
+            deadline = time.monotonic() + BATCH_WAIT
+    return items, False
+
+def classify_worker(frame_queue, result_queue, near_dups=None):
+    """Classification stage: stops taking new frames once exit is requested."""
+    finished = False
+    while not finished and not exit_requested:
+        items, finished = next_batch(frame_queue)
+        for item, (raw_result, local) in zip(items, classify_items(items, near_dups)):
+            video_path, frame_idx, fps, img_bytes, _ = item
+            result_queue.put((video_path, frame_idx, fps, img_bytes, raw_result, local))
+    result_queue.put(_STAGE_DONE)
+
+def sorter_worker(result_queue, num_classifiers, pbar):
+    """Single sorter stage: the only writer of output files and progress."""
+    finished = 0
+    while finished < num_classifiers:
+        item = result_queue.get()
+        if item is _STAGE_DONE:
+            finished += 1
+            continue
+        video_path, frame_idx, fps, img_bytes, raw_result, local = item
+        if raw_result is not None:
+            with metrics.span("write"):
+                out_name = sort_frame(video_path, frame_idx, fps, img_bytes, raw_result, AUTO_SUFFIX if local else "")
+            tqdm.write(f"Processed: {out_name} -> {raw_result}{' (local)' if local else ''}")
+        pbar.update(1)
+
+def put_until_exit(q, item):
+    """Blocking put that gives up once exit is requested (the consumers may be gone)."""
+    while not exit_requested:
+        try:
+            q.put(item, timeout=0.2)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def run_pipeline(plan, video_info, probe_cache, pbar, near_dups=None):
+    frame_queue = queue.Queue(maxsize=FRAME_QUEUE_SIZE)
+    result_queue = queue.Queue()
+
+    classifiers = [
+        threading.Thread(target=classify_worker, args=(frame_queue, result_queue, near_dups), daemon=True)
+        for _ in range(max(1, CLASSIFY_WORKERS))
+    ]
+    sorter = threading.Thread(target=sorter_worker, args=(result_queue, len(classifiers), pbar), daemon=True)
+    for t in classifiers + [sorter]:
+        t.start()
+
+    pending = list(plan.items())
+    pending.reverse()
+    in_flight = []
+    with ProcessPoolExecutor(max_workers=DECODE_WORKERS, initializer=init_decode_worker) as pool:
+        # Keep a couple of videos decoding per process; the frame queue bounds the rest
+        while (pending or in_flight) and not exit_requested:
+            while pending and len(in_flight) < DECODE_WORKERS * 2:
+                video_path, count = pending.pop()
+                future = pool.submit(decode_video, video_path, count, video_info.get(video_path))
+                in_flight.append((video_path, future))
+
+            video_path, future = in_flight.pop(0)
+            try:
+                # Time the main loop sits waiting on decode; large means decode is the bottleneck
+                with metrics.span("decode_wait", video_path):
+                    info, frames, quality, error = future.result()
+            except Exception as e:
+                info, frames, quality, error = None, [], {}, f"Decode failed for {video_path}: {e}"
+            if error:
+                tqdm.write(error)
+            for reason, n in quality.get("rejected", {}).items():
+                metrics.count(f"rejected_{reason}", n)
+            if quality.get("dropped"):
+                metrics.count("samples_dropped", quality["dropped"])
+            if info and info.get("partial") and video_path not in video_info:
+                # No ffmpeg: remember what OpenCV reported for the next run
+                probe_cache.put(video_path, info)
+                video_info[video_path] = info
+
+            for frame_idx, img_bytes, phash in frames:
+                if not put_until_exit(frame_queue, (video_path, frame_idx, info["fps"], img_bytes, phash)):
+                    break
+
+        for _, future in in_flight:
+            future.cancel()
+
+        # Let every classifier finish; on exit they stop after their in-flight request
+        for _ in classifiers:
+            put_until_exit(frame_queue, _STAGE_DONE)
+        for t in classifiers:
+            t.join()
+        sorter.join()
+
 def main():
     # 1. Setup Directories
     for folder in DIRS.values():
@@ -122,6 +605,21 @@ def main():
         return
 
     print(f"Found {len(video_files)} videos.")
+
+    # Bulk-probe metadata in parallel (cached), so frame selection needs no container opens
+    probe_cache = ProbeCache(PROBE_CACHE_FILE)
+    if find_ffprobe() or find_ffmpeg():
+        with metrics.span("probe", videos=len(video_files)):
+            video_info = probe_cache.probe_many(video_files, workers=PROBE_WORKERS)
+    else:
+        video_info = {}
+    empty = [v for v, info in video_info.items() if not info.get("frame_count")]
+    if empty:
+        video_files = [v for v in video_files if v not in empty]
+        print(f"Ignoring {len(empty)} videos with no frames.")
+    if not video_files:
+        print("No readable video files found.")
+        return
     
     try:
         num_to_extract = int(input("How many total frames would you like to extract? "))
@@ -129,67 +627,28 @@ def main():
         print("Invalid number.")
         return
 
-    # 3. Processing Loop
-    pool = []
+    # 3. Processing Pipeline: one open per video, decode and classification overlap
+    global preclassifier
+    if ENABLE_PRECLASSIFIER:
+        preclassifier = load_preclassifier()
+    plan = plan_samples(video_files, num_to_extract)
+    near_dups = None
+    if ENABLE_PHASH:
+        near_dups = PerceptualIndex(f"sorter:{make_prompt_key(CLASSIFY_PROMPT, MODEL_ID)}", PHASH_FILE, PHASH_MAX_DISTANCE)
     with tqdm(total=num_to_extract, unit="frame", desc="Overall Progress") as pbar:
-        for i in range(num_to_extract):
-            if exit_requested: break
-
-            # Refill pool if empty to ensure every video is picked before repeating
-            if not pool:
-                pool = video_files.copy()
-                random.shuffle(pool)
-
-            video_path = pool.pop()
-            filename_slug = os.path.splitext(os.path.basename(video_path))[0]
-
-            cap = cv2.VideoCapture(video_path)
-            if not cap.isOpened():
-                tqdm.write(f"Failed to open {video_path}")
-                continue
-
-            fps = cap.get(cv2.CAP_PROP_FPS)
-            total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-            
-            if total_frames <= 0:
-                cap.release()
-                continue
-
-            # Random frame selection based on rules
-            frame_idx = get_valid_frame_index(cap, fps, total_frames)
-            timestamp_sec = int(frame_idx / fps)
-            
-            cap.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
-            success, frame = cap.read()
-            cap.release()
-
-            if success:
-                # Convert frame to jpg in memory
-                _, buffer = cv2.imencode('.jpg', frame)
-                img_bytes = buffer.tobytes()
-
-                # Classification
-                raw_result = classify_frame(img_bytes)
-                classification = raw_result.lower()
-
-                # Sorting Logic
-                target_folder = DIRS["None"]
-                if "adult male" in classification: target_folder = DIRS["Adult Male"]
-                elif "adult female" in classification: target_folder = DIRS["Adult Female"]
-                elif "child" in classification: target_folder = DIRS["Child"]
-                elif "animal" in classification: target_folder = DIRS["Animal"]
-
-                # File Naming: [Original]_[Timestamp]_[FrameID].jpg
-                out_name = f"{filename_slug}_T{timestamp_sec}s_F{frame_idx}.jpg"
-                out_path = os.path.join(target_folder, out_name)
-
-                with open(out_path, "wb") as f:
-                    f.write(img_bytes)
-
-                tqdm.write(f"Processed: {out_name} -> {raw_result}")
-            
-            pbar.update(1)
-
+        run_pipeline(plan, video_info, probe_cache, pbar, near_dups)
+
+    probe_cache.close()
+    print(lm.stats.report())
+    if preclassifier is not None:
+        print(agreement.report())
+    rejected = sum(n for name, n in metrics.counters.items() if name.startswith("rejected_"))
+    print(f"Quality filter: {rejected} candidate frames rejected, "
+          f"{metrics.counters.get('samples_dropped', 0)} samples dropped with no usable frame")
+    metrics.close()
+    if near_dups is not None:
+        print(f"Near-duplicate frames found: {near_dups.hits}")
+        near_dups.close()
     print("\nDone! All files sorted.")
 
 if __name__ == "__main__":
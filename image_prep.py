@@ -0,0 +1,246 @@
+import io
+import os
+import sys
+import base64
+import signal
+import sqlite3
+import hashlib
+import argparse
+import threading
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, UnidentifiedImageError
+from prompt_cache import hash_file
+from phash_index import dhash_pil
+
+# =================================================================================
+#  VISION PAYLOAD PREPARATION
+#  Turns source images into the small JPEG a vision model actually sees. JPEGs are
+#  decoded straight at a reduced scale (draft mode), so a 40MP photo never gets
+#  fully decoded; the rest is a cheap resize. Work runs in a process pool ahead of
+#  the LLM, and the encoded payloads are cached on disk by content hash.
+#
+#  Each file is read exactly once: the same bytes give the content hash, the
+#  header size (for resolution bucketing), the perceptual hash and the payload.
+# =================================================================================
+
+DEFAULT_CACHE_FILE = "vision_payloads.db"
+
+# After draft decoding the remaining downscale is under 2x, where bicubic is
+# indistinguishable from Lanczos for the model and noticeably faster
+DEFAULT_RESAMPLE = Image.Resampling.BICUBIC
+
+# One scanned image; payload is base64 (None on error or when it wasn't needed), size is the
+# original (width, height), phash the dHash when it was asked for
+PreparedImage = namedtuple("PreparedImage", "path image_hash payload size error phash", defaults=(None,))
+
+def encode_for_vision(path, max_size=768, quality=85, resample=DEFAULT_RESAMPLE):
+    """JPEG bytes of an image (path or file object), fit within max_size x max_size."""
+    with Image.open(path) as img:
+        # JPEG only: the decoder picks the smallest 1/2, 1/4 or 1/8 scale still >= max_size
+        img.draft('RGB', (max_size, max_size))
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        if max(img.size) > max_size:
+            # reducing_gap box-reduces large non-JPEG sources before the real resample
+            img.thumbnail((max_size, max_size), resample, reducing_gap=2.0)
+        buffered = io.BytesIO()
+        img.save(buffered, format="JPEG", quality=quality)
+        return buffered.getvalue()
+
+class PayloadCache:
+    def __init__(self, path=DEFAULT_CACHE_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS payloads (
+                image_hash TEXT NOT NULL,
+                variant TEXT NOT NULL,
+                payload BLOB NOT NULL,
+                PRIMARY KEY (image_hash, variant)
+            ) WITHOUT ROWID
+        """)
+        self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM payloads").fetchone()[0]
+
+    def get(self, image_hash, variant):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT payload FROM payloads WHERE image_hash = ? AND variant = ?", (image_hash, variant)
+            ).fetchone()
+        return bytes(row[0]) if row else None
+
+    def put(self, image_hash, variant, payload):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO payloads (image_hash, variant, payload) VALUES (?, ?, ?)",
+                (image_hash, variant, payload)
+            )
+            self._conn.commit()
+
+    def compact(self):
+        with self._lock:
+            self._conn.execute("VACUUM")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+# Per-process read handle for pool workers; the parent is the only writer
+_worker_cache = None
+# Content hashes whose payload isn't needed (e.g. already described), or None for all of them
+_worker_skip = frozenset()
+_worker_phash = False
+
+def _init_worker(cache_path, skip_hashes=frozenset(), phash=False):
+    global _worker_cache, _worker_skip, _worker_phash
+    # Ctrl+C is handled by the parent, which winds the pool down itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if cache_path and os.path.exists(cache_path):
+        _worker_cache = PayloadCache(cache_path)
+    _worker_skip = skip_hashes
+    _worker_phash = phash
+
+def _prepare(path, variant, max_size, quality):
+    """Worker task: returns (image_hash, jpeg_bytes, from_cache, size, error, phash)."""
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        image_hash = hashlib.sha256(data).hexdigest()  # Same digest as prompt_cache.hash_file
+        skip = _worker_skip is None or image_hash in _worker_skip
+        with Image.open(io.BytesIO(data)) as img:
+            size = img.size  # Header only, no pixel decode
+            # From the bytes already in memory, at draft scale; skipped images don't need one
+            phash = dhash_pil(img) if _worker_phash and not skip else None
+        if skip:
+            return image_hash, None, False, size, None, None
+        if _worker_cache is not None:
+            payload = _worker_cache.get(image_hash, variant)
+            if payload is not None:
+                return image_hash, payload, True, size, None, phash
+        return image_hash, encode_for_vision(io.BytesIO(data), max_size, quality), False, size, None, phash
+    except UnidentifiedImageError:
+        return None, None, False, None, "not a readable image", None
+    except Exception as e:
+        return None, None, False, None, str(e), None
+
+class ImagePrep:
+    def __init__(self, cache_path=DEFAULT_CACHE_FILE, workers=None, max_size=768, quality=85):
+        self.cache_path = cache_path
+        self.workers = workers or max(1, (os.cpu_count() or 2) // 2)
+        self.max_size = max_size
+        self.quality = quality
+        self.variant = f"{max_size}:q{quality}"
+        self.hits = 0
+        self.misses = 0
+        self._cache = None
+        self._lock = threading.Lock()
+
+    @property
+    def cache(self):
+        # Opened on first use, so importing a script doesn't create the database
+        with self._lock:
+            if self._cache is None and self.cache_path:
+                self._cache = PayloadCache(self.cache_path)
+            return self._cache
+
+    def _count(self, hit):
+        # encode() runs on several describe threads at once
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def encode(self, path, image_hash=None):
+        """Base64 payload for one image, from the cache or encoded inline."""
+        cache = self.cache
+        if cache is not None:
+            image_hash = image_hash or hash_file(path)
+            payload = cache.get(image_hash, self.variant)
+            if payload is not None:
+                self._count(True)
+                return base64.b64encode(payload).decode('utf-8')
+        self._count(False)
+        payload = encode_for_vision(path, self.max_size, self.quality)
+        if cache is not None:
+            cache.put(image_hash, self.variant, payload)
+        return base64.b64encode(payload).decode('utf-8')
+
+    def iter_prepared(self, paths, ahead=None, skip_hashes=frozenset(), phash=False):
+        """Yields a PreparedImage per path, in input order, while a process pool
+        prepares up to `ahead` images beyond the one being consumed. Images whose content
+        hash is in skip_hashes (every image, if it is None) are hashed and sized but get
+        no payload. phash=True also computes the dHash of every image that gets one."""
+        ahead = ahead or self.workers * 2
+        self.cache  # Create the database before the workers try to open it
+        pending = list(paths)
+        pending.reverse()
+        window = []
+        pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                   initargs=(self.cache_path, skip_hashes, phash))
+        try:
+            while pending or window:
+                while pending and len(window) < ahead:
+                    path = pending.pop()
+                    window.append((path, pool.submit(_prepare, path, self.variant, self.max_size, self.quality)))
+                path, future = window.pop(0)
+                try:
+                    image_hash, payload, from_cache, size, error, phash_value = future.result()
+                except Exception as e:
+                    image_hash, payload, from_cache, size, error, phash_value = None, None, False, None, str(e), None
+                if payload is None:
+                    yield PreparedImage(path, image_hash, None, size, error)
+                    continue
+                self._count(from_cache)
+                if not from_cache and self.cache is not None:
+                    self.cache.put(image_hash, self.variant, payload)
+                yield PreparedImage(path, image_hash, base64.b64encode(payload).decode('utf-8'), size, None, phash_value)
+        finally:
+            # Runs when the consumer stops early too: drop queued work, don't wait for it
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def close(self):
+        with self._lock:
+            if self._cache is not None:
+                self._cache.close()
+                self._cache = None
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-encode vision payloads for a folder of images.")
+    parser.add_argument("folder", nargs="?", default=".")
+    parser.add_argument("--cache", default=DEFAULT_CACHE_FILE)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--max-size", type=int, default=768)
+    parser.add_argument("--compact", action="store_true", help="VACUUM the cache and exit")
+    args = parser.parse_args()
+
+    if args.compact:
+        if not os.path.exists(args.cache):
+            print(f"No cache found at {args.cache}")
+            sys.exit(1)
+        cache = PayloadCache(args.cache)
+        size_before = os.path.getsize(args.cache)
+        cache.compact()
+        print(f"{len(cache)} payloads. {size_before} -> {os.path.getsize(args.cache)} bytes")
+        cache.close()
+        return
+
+    valid_exts = ('.jpg', '.jpeg', '.png', '.webp')
+    files = [os.path.join(args.folder, f) for f in os.listdir(args.folder) if f.lower().endswith(valid_exts)]
+    prep = ImagePrep(args.cache, args.workers, args.max_size)
+    failed = 0
+    for item in prep.iter_prepared(files):
+        if item.error:
+            failed += 1
+            print(f"[!] {item.path}: {item.error}")
+    print(f"{len(files) - failed} payloads ({prep.hits} already cached, {prep.misses} encoded) -> {args.cache}")
+    prep.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+import sys
+import json
+import time
+import base64
+import random
+import argparse
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+# =================================================================================
+#  SHARED LM STUDIO VISION CLIENT
+#  One pooled keep-alive session per script instead of a fresh TCP connection per
+#  request, a cap on concurrent requests, exponential backoff with jitter on
+#  timeouts/connection errors/5xx/429, and per-request latency statistics.
+#  Works against any OpenAI-compatible /v1/chat/completions endpoint.
+# =================================================================================
+
+class LMError(Exception):
+    pass
+
+def image_message(text, base64_image, mime="image/jpeg"):
+    """A single user message carrying an instruction and one base64 image."""
+    return {"role": "user", "content": [
+        {"type": "text", "text": text},
+        {"type": "image_url", "image_url": {"url": f"data:{mime};base64,{base64_image}"}}
+    ]}
+
+def images_message(text, base64_images, mime="image/jpeg"):
+    """A single user message carrying an instruction and several base64 images, in order."""
+    return {"role": "user", "content": [{"type": "text", "text": text}] + [
+        {"type": "image_url", "image_url": {"url": f"data:{mime};base64,{b64}"}} for b64 in base64_images
+    ]}
+
+class LatencyStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = []     # Wall seconds per successful call, including retries and slot waits
+        self.errors = 0
+        self.retries = 0
+
+    def record(self, seconds):
+        with self._lock:
+            self.samples.append(seconds)
+
+    def count_retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def count_error(self):
+        with self._lock:
+            self.errors += 1
+
+    def summary(self):
+        with self._lock:
+            samples = sorted(self.samples)
+            errors, retries = self.errors, self.retries
+        if not samples:
+            return {"requests": 0, "errors": errors, "retries": retries}
+
+        def pct(p):
+            return samples[min(len(samples) - 1, int(round(p / 100 * (len(samples) - 1))))]
+
+        return {
+            "requests": len(samples), "errors": errors, "retries": retries,
+            "mean": sum(samples) / len(samples), "p50": pct(50), "p95": pct(95), "max": samples[-1],
+        }
+
+    def report(self):
+        s = self.summary()
+        if not s["requests"]:
+            return f"LM requests: 0 ok, {s['errors']} failed, {s['retries']} retries"
+        return (f"LM requests: {s['requests']} ok, {s['errors']} failed, {s['retries']} retries | "
+                f"latency mean {s['mean']:.2f}s, p50 {s['p50']:.2f}s, p95 {s['p95']:.2f}s, max {s['max']:.2f}s")
+
+class VisionClient:
+    def __init__(self, url, model, timeout=120, max_concurrency=4, max_retries=3,
+                 backoff_base=1.0, backoff_max=30.0, metrics=None):
+        self.url = url
+        self.model = model
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.stats = LatencyStats()
+        self.metrics = metrics  # Optional pipeline_metrics.Metrics: "llm_request" spans + "llm_retries"
+        self._slots = threading.BoundedSemaphore(max(1, max_concurrency))
+
+        # Enough pooled connections for every concurrent caller, so none are discarded
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, max_concurrency))
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _backoff(self, attempt, retry_after=None):
+        """Full-jitter exponential backoff; a server's Retry-After wins when it is longer."""
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+        if retry_after:
+            try:
+                delay = max(delay, min(self.backoff_max, float(retry_after)))
+            except ValueError:
+                pass
+        return delay
+
+    def chat(self, messages, **params):
+        """Sends a chat completion and returns the reply text. Raises LMError once retries are exhausted
+        or on a non-retryable failure (4xx, malformed response)."""
+        return self._complete(messages, params)
+
+    def chat_stream(self, messages, on_text=None, **params):
+        """Like chat, but the reply is streamed. on_text(text_so_far) is called as chunks arrive;
+        returning True stops there (closing the connection aborts the generation server-side)
+        and the partial text is returned. on_text("") marks the start of each attempt, since a
+        reply that drops mid-stream is retried from the beginning."""
+        return self._complete(messages, params, on_text=on_text, stream=True)
+
+    def _read_stream(self, response, on_text):
+        """Collects the text of a server-sent-events reply."""
+        response.encoding = 'utf-8'
+        text = ""
+        if on_text is not None:
+            on_text(text)
+        try:
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                try:
+                    delta = json.loads(data)['choices'][0].get('delta', {}).get('content')
+                except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+                    continue  # Keep-alives, usage chunks and the like
+                if delta:
+                    text += delta
+                    if on_text is not None and on_text(text):
+                        break
+        finally:
+            response.close()
+        return text
+
+    def _complete(self, messages, params, on_text=None, stream=False):
+        payload = {"model": self.model, "messages": messages}
+        payload.update(params)
+        if stream:
+            payload["stream"] = True
+
+        start = time.perf_counter()
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            with self._slots:
+                try:
+                    response = self.session.post(self.url, json=payload, timeout=self.timeout, stream=stream)
+                except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+                    last_error = e
+                else:
+                    if response.status_code == 429 or response.status_code >= 500:
+                        last_error = f"HTTP {response.status_code}"
+                        retry_after = response.headers.get("Retry-After")
+                        response.close()
+                    elif response.status_code != 200:
+                        self._failed(start)
+                        raise LMError(f"HTTP {response.status_code}: {response.text[:200]}")
+                    elif stream:
+                        try:
+                            return self._succeeded(start, attempt, self._read_stream(response, on_text))
+                        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError,
+                                requests.exceptions.ChunkedEncodingError) as e:
+                            last_error = e  # Dropped mid-reply: retried from the start
+                    else:
+                        try:
+                            content = response.json()['choices'][0]['message']['content']
+                        except (ValueError, KeyError, IndexError, TypeError) as e:
+                            self._failed(start)
+                            raise LMError(f"Malformed response: {e}")
+                        return self._succeeded(start, attempt, content)
+
+            # Sleep outside the semaphore so a backing-off request doesn't hold a slot
+            if attempt < self.max_retries:
+                self.stats.count_retry()
+                if self.metrics is not None:
+                    self.metrics.count("llm_retries")
+                time.sleep(self._backoff(attempt, retry_after))
+
+        self._failed(start)
+        raise LMError(f"Failed after {self.max_retries + 1} attempts: {last_error}")
+
+    def _succeeded(self, start, attempt, content):
+        elapsed = time.perf_counter() - start
+        self.stats.record(elapsed)
+        if self.metrics is not None:
+            self.metrics.record("llm_request", elapsed, retries=attempt)
+        return (content or "").strip()
+
+    def _failed(self, start):
+        self.stats.count_error()
+        if self.metrics is not None:
+            self.metrics.record("llm_request", time.perf_counter() - start, ok=False)
+
+    def describe(self, text, base64_image, mime="image/jpeg", **params):
+        """Convenience wrapper: one instruction + one image -> reply text."""
+        return self.chat([image_message(text, base64_image, mime)], **params)
+
+    def close(self):
+        self.session.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Send an image to an OpenAI-compatible vision endpoint.")
+    parser.add_argument("image")
+    parser.add_argument("--url", default="http://127.0.0.1:1234/v1/chat/completions")
+    parser.add_argument("--model", default="qwen/qwen3-vl-8b")
+    parser.add_argument("--prompt", default="Describe this image.")
+    parser.add_argument("--repeat", type=int, default=1, help="Send the same request N times")
+    parser.add_argument("--concurrency", type=int, default=1)
+    args = parser.parse_args()
+
+    with open(args.image, 'rb') as f:
+        base64_image = base64.b64encode(f.read()).decode('utf-8')
+
+    client = VisionClient(args.url, args.model, max_concurrency=args.concurrency)
+
+    def run(_):
+        try:
+            return client.describe(args.prompt, base64_image)
+        except LMError as e:
+            return f"[!] {e}"
+
+    with ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as pool:
+        replies = list(pool.map(run, range(max(1, args.repeat))))
+    print(replies[-1])
+    print(client.stats.report())
+    client.close()
+    sys.exit(0 if client.stats.summary()["requests"] else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+import sqlite3
+import threading
+import numpy as np
+
+# =================================================================================
+#  PERCEPTUAL-HASH NEAR-DUPLICATE INDEX
+#  64-bit difference hashes (dHash) computed with NumPy, stored in SQLite per
+#  namespace, so a near-identical image or frame can reuse an earlier LLM result
+#  instead of paying for another vision round trip.
+# =================================================================================
+
+DEFAULT_INDEX_FILE = "phash_index.db"
+HASH_BITS = 64
+
+def _area_resize(gray, out_h, out_w):
+    """Block-mean downscale of a 2D array (box filter), no OpenCV/PIL needed."""
+    h, w = gray.shape
+    rows = np.linspace(0, h, out_h + 1).astype(int)
+    cols = np.linspace(0, w, out_w + 1).astype(int)
+    # Guard against empty bins on images smaller than the hash grid
+    rows = np.minimum(rows, h - 1)[:-1]
+    cols = np.minimum(cols, w - 1)[:-1]
+    summed = np.add.reduceat(np.add.reduceat(gray.astype(np.float64), rows, axis=0), cols, axis=1)
+    counts = np.outer(np.diff(np.append(rows, h)), np.diff(np.append(cols, w)))
+    return summed / np.maximum(counts, 1)
+
+def dhash(gray):
+    """64-bit difference hash of a 2D grayscale array: each bit is 'brighter than the pixel to its right'."""
+    gray = np.asarray(gray)
+    if gray.ndim == 3:
+        gray = gray.mean(axis=2)
+    small = _area_resize(gray, 8, 9)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int(np.packbits(bits).view('>u8')[0])
+
+def dhash_pil(img):
+    """dHash of an opened PIL image whose pixels aren't loaded yet. JPEG draft mode decodes at
+    reduced size, so this is cheap even for large photos."""
+    img.draft('L', (128, 128))
+    return dhash(np.asarray(img.convert('L')))
+
+def dhash_image(path):
+    """dHash of an image file (path or file object)."""
+    from PIL import Image
+    with Image.open(path) as img:
+        return dhash_pil(img)
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+def _to_signed(h):
+    # SQLite INTEGER is signed 64-bit
+    return h - (1 << 64) if h >= (1 << 63) else h
+
+def _popcount(values):
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values)
+    return np.unpackbits(values.view(np.uint8)).reshape(-1, HASH_BITS).sum(axis=1)
+
+class PerceptualIndex:
+    def __init__(self, namespace, path=DEFAULT_INDEX_FILE, max_distance=4, load_existing=True, legacy_namespace=None):
+        """load_existing=False starts with an empty in-memory view (matches only within this run)
+        but still persists new hashes for later runs. Rows stored under legacy_namespace are
+        moved to namespace on open."""
+        self.namespace = namespace
+        self.max_distance = max_distance
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS phashes (
+                namespace TEXT NOT NULL,
+                hash INTEGER NOT NULL,
+                value TEXT NOT NULL,
+                source TEXT,
+                PRIMARY KEY (namespace, hash)
+            )
+        """)
+        if legacy_namespace and legacy_namespace != namespace:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO phashes (namespace, hash, value, source) "
+                "SELECT ?, hash, value, source FROM phashes WHERE namespace = ?", (namespace, legacy_namespace)
+            )
+            self._conn.execute("DELETE FROM phashes WHERE namespace = ?", (legacy_namespace,))
+        self._conn.commit()
+
+        rows = []
+        if load_existing:
+            rows = self._conn.execute("SELECT hash, value FROM phashes WHERE namespace = ?", (namespace,)).fetchall()
+        # Over-allocated and doubled when full, so adding a hash doesn't copy the whole array;
+        # only the first len(self._values) entries are in use
+        self._hashes = np.zeros(max(64, len(rows)), dtype=np.uint64)
+        self._hashes[:len(rows)] = np.array([h for h, _ in rows], dtype=np.int64).view(np.uint64)
+        self._values = [v for _, v in rows]
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._values)
+
+    def find(self, h):
+        """(value, distance) of the closest stored hash within max_distance, else None."""
+        with self._lock:
+            if not len(self._values):
+                self.misses += 1
+                return None
+            distances = _popcount(np.bitwise_xor(self._hashes[:len(self._values)], np.uint64(h)))
+            best = int(np.argmin(distances))
+            distance = int(distances[best])
+            if distance > self.max_distance:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return self._values[best], distance
+
+    def add(self, h, value, source=None):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO phashes (namespace, hash, value, source) VALUES (?, ?, ?, ?)",
+                (self.namespace, _to_signed(h), value, source)
+            )
+            self._conn.commit()
+            n = len(self._values)
+            if n == len(self._hashes):
+                grown = np.zeros(2 * n, dtype=np.uint64)
+                grown[:n] = self._hashes
+                self._hashes = grown
+            self._hashes[n] = np.uint64(h)
+            self._values.append(value)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,203 @@
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from contextlib import contextmanager
+
+# =================================================================================
+#  PIPELINE INSTRUMENTATION
+#  Per-item, per-stage spans (vision, upload, queue wait, render, encode, ...) and
+#  simple counters, with a summary table at the end of a run. Spans are appended
+#  to a JSONL file as they happen and totals can be written as a Prometheus
+#  textfile, so a run shows whether the LLM, the GPU or the disk is the bottleneck.
+# =================================================================================
+
+def _percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))]
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+class Metrics:
+    def __init__(self, run_name, jsonl_path=None, prom_path=None):
+        self.run_name = run_name
+        self.jsonl_path = jsonl_path
+        self.prom_path = prom_path
+        self.started = time.time()
+        self.ended = None      # Set when summarizing an export; otherwise "now"
+        self._lock = threading.Lock()
+        self._durations = {}   # stage -> [seconds]
+        self._errors = {}      # stage -> count
+        self._order = []       # stages in first-seen order, for the report
+        self.counters = {}
+        self._jsonl = None     # Opened on the first span, so importing a script creates no file
+        self._closed = False
+
+    def record(self, stage, seconds, item=None, ok=True, **fields):
+        """Records one finished span. Extra fields only go to the JSONL export."""
+        with self._lock:
+            if stage not in self._durations:
+                self._durations[stage] = []
+                self._errors[stage] = 0
+                self._order.append(stage)
+            self._durations[stage].append(seconds)
+            if not ok:
+                self._errors[stage] += 1
+            if self._jsonl is None and self.jsonl_path and not self._closed:
+                self._jsonl = open(self.jsonl_path, 'a', encoding='utf-8')
+            if self._jsonl is not None:
+                event = {"run": self.run_name, "ts": round(time.time(), 3), "stage": stage,
+                         "seconds": round(seconds, 4), "ok": ok}
+                if item is not None:
+                    event["item"] = str(item)
+                event.update(fields)
+                self._jsonl.write(json.dumps(event, ensure_ascii=False, default=str) + "\n")
+                self._jsonl.flush()
+
+    @contextmanager
+    def span(self, stage, item=None, **fields):
+        """Times a block; an exception marks the span as failed and is re-raised."""
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.record(stage, time.perf_counter() - start, item, ok=False, **fields)
+            raise
+        self.record(stage, time.perf_counter() - start, item, **fields)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def summary(self):
+        """One row per stage: count, errors, total, mean, p50, p95, max seconds."""
+        with self._lock:
+            stages = [(s, sorted(self._durations[s]), self._errors[s]) for s in self._order]
+        rows = []
+        for stage, values, errors in stages:
+            total = sum(values)
+            rows.append({
+                "stage": stage, "count": len(values), "errors": errors, "total": total,
+                "mean": total / len(values), "p50": _percentile(values, 50),
+                "p95": _percentile(values, 95), "max": values[-1],
+            })
+        return rows
+
+    def report(self):
+        wall = (self.ended or time.time()) - self.started
+        lines = [f"--- {self.run_name} timings ({wall:.1f}s wall) ---",
+                 f"{'stage':<22} {'count':>6} {'err':>4} {'total s':>9} {'mean s':>8} {'p50 s':>8} {'p95 s':>8} {'max s':>8}"]
+        for r in self.summary():
+            lines.append(f"{r['stage']:<22} {r['count']:>6} {r['errors']:>4} {r['total']:>9.1f} "
+                         f"{r['mean']:>8.3f} {r['p50']:>8.3f} {r['p95']:>8.3f} {r['max']:>8.3f}")
+        with self._lock:
+            counters = sorted(self.counters.items())
+        if counters:
+            lines.append("counters: " + ", ".join(f"{k}={v}" for k, v in counters))
+        return "\n".join(lines)
+
+    def write_prometheus(self, path=None):
+        """Writes totals in the node_exporter textfile-collector format, atomically."""
+        path = path or self.prom_path
+        if not path:
+            return
+        run = _label(self.run_name)
+        out = [
+            "# HELP pipeline_stage_seconds_total Time spent per pipeline stage.",
+            "# TYPE pipeline_stage_seconds_total counter",
+        ]
+        rows = self.summary()
+        for r in rows:
+            out.append(f'pipeline_stage_seconds_total{{run="{run}",stage="{_label(r["stage"])}"}} {r["total"]:.6f}')
+        out += ["# HELP pipeline_stage_spans_total Spans recorded per pipeline stage.",
+                "# TYPE pipeline_stage_spans_total counter"]
+        for r in rows:
+            out.append(f'pipeline_stage_spans_total{{run="{run}",stage="{_label(r["stage"])}"}} {r["count"]}')
+        out += ["# HELP pipeline_stage_errors_total Failed spans per pipeline stage.",
+                "# TYPE pipeline_stage_errors_total counter"]
+        for r in rows:
+            out.append(f'pipeline_stage_errors_total{{run="{run}",stage="{_label(r["stage"])}"}} {r["errors"]}')
+        out += ["# HELP pipeline_stage_seconds Span duration quantiles per pipeline stage.",
+                "# TYPE pipeline_stage_seconds gauge"]
+        for r in rows:
+            for q in ("p50", "p95", "max"):
+                out.append(f'pipeline_stage_seconds{{run="{run}",stage="{_label(r["stage"])}",quantile="{q}"}} {r[q]:.6f}')
+        with self._lock:
+            counters = sorted(self.counters.items())
+        if counters:
+            out += ["# HELP pipeline_events_total Pipeline event counters.",
+                    "# TYPE pipeline_events_total counter"]
+            for name, value in counters:
+                out.append(f'pipeline_events_total{{run="{run}",name="{_label(name)}"}} {value}')
+        out.append(f'pipeline_run_seconds{{run="{run}"}} {(self.ended or time.time()) - self.started:.3f}')
+
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write("\n".join(out) + "\n")
+        os.replace(tmp_path, path)
+
+    def close(self, print_report=True):
+        if print_report:
+            print("\n" + self.report())
+        self.write_prometheus()
+        with self._lock:
+            self._closed = True
+            if self._jsonl is not None:
+                self._jsonl.close()
+                self._jsonl = None
+
+def timed_iter(iterable, metrics, stage):
+    """Yields from iterable, recording how long the consumer waited for each item
+    (a producer-side bottleneck shows up as a large wait)."""
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        metrics.record(stage, time.perf_counter() - start)
+        yield item
+
+def summarize_jsonl(path, run=None):
+    """Rebuilds a Metrics summary from an exported JSONL file (optionally one run name only)."""
+    metrics = None
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            if run and event.get("run") != run:
+                continue
+            if metrics is None:
+                metrics = Metrics(run or event.get("run", "run"))
+                metrics.started = event.get("ts", time.time())
+            metrics.ended = event.get("ts", metrics.ended)
+            metrics.record(event["stage"], event["seconds"], ok=event.get("ok", True))
+    return metrics
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize a pipeline metrics JSONL export.")
+    parser.add_argument("jsonl")
+    parser.add_argument("--run", help="Only events from this run name (reimagine, animate, ...)")
+    parser.add_argument("--prom", help="Also write a Prometheus textfile here")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.jsonl):
+        print(f"No metrics found at {args.jsonl}")
+        sys.exit(1)
+    metrics = summarize_jsonl(args.jsonl, args.run)
+    if metrics is None:
+        print("No matching events.")
+        sys.exit(1)
+    print(metrics.report())
+    if args.prom:
+        metrics.write_prometheus(args.prom)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+import os
+import csv
+import sys
+import time
+import sqlite3
+import hashlib
+import argparse
+import threading
+
+# =================================================================================
+#  CONTENT-ADDRESSED PROMPT CACHE
+#  Descriptions are keyed by the SHA-256 of the image bytes plus a key derived
+#  from the instruction text and model ID, so renamed or duplicated images hit
+#  the cache and changing the prompt or model never returns stale results.
+# =================================================================================
+
+DEFAULT_CACHE_FILE = "reimagine_cache.db"
+
+def hash_file(path, chunk_size=1 << 20):
+    """SHA-256 of a file's contents, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def make_prompt_key(instruction, model_id):
+    """Short stable ID for an (instruction, model) pair."""
+    return hashlib.sha256(f"{model_id}\n{instruction}".encode('utf-8')).hexdigest()[:16]
+
+class PromptCache:
+    def __init__(self, path=DEFAULT_CACHE_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        # Shared between the pipeline's worker threads; all access goes through _lock
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS prompts (
+                image_hash TEXT NOT NULL,
+                prompt_key TEXT NOT NULL,
+                description TEXT NOT NULL,
+                filename TEXT,
+                created REAL NOT NULL,
+                PRIMARY KEY (image_hash, prompt_key)
+            ) WITHOUT ROWID
+        """)
+        self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM prompts").fetchone()[0]
+
+    def get(self, image_hash, prompt_key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT description FROM prompts WHERE image_hash = ? AND prompt_key = ?",
+                (image_hash, prompt_key)
+            ).fetchone()
+        return row[0] if row else None
+
+    def put(self, image_hash, prompt_key, description, filename=None):
+        """Stores a description; an existing entry for the same image and prompt is replaced."""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO prompts (image_hash, prompt_key, description, filename, created) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (image_hash, prompt_key, description, filename, time.time())
+            )
+            self._conn.commit()
+
+    def hashes(self, prompt_key):
+        """Content hashes of every image already described with this prompt key."""
+        with self._lock:
+            rows = self._conn.execute("SELECT image_hash FROM prompts WHERE prompt_key = ?", (prompt_key,)).fetchall()
+        return frozenset(r[0] for r in rows)
+
+    def entries(self, prompt_key=None):
+        """Every cached (image_hash, prompt_key, description, filename), optionally for one prompt key."""
+        with self._lock:
+            if prompt_key:
+                return self._conn.execute(
+                    "SELECT image_hash, prompt_key, description, filename FROM prompts WHERE prompt_key = ?",
+                    (prompt_key,)
+                ).fetchall()
+            return self._conn.execute("SELECT image_hash, prompt_key, description, filename FROM prompts").fetchall()
+
+    def import_csv(self, log_file, prompt_key):
+        """One-off migration from the old reimagine_log.csv (Filename -> Prompt).
+        Rows whose image is no longer on disk are skipped; existing entries win."""
+        imported = 0
+        if not os.path.exists(log_file):
+            return imported
+        with open(log_file, 'r', encoding='utf-8') as f:
+            rows = [r for r in csv.DictReader(f) if r.get("Filename") and r.get("Prompt")]
+
+        with self._lock:
+            for row in rows:
+                filename = row["Filename"]
+                if not os.path.isfile(filename):
+                    continue
+                try:
+                    image_hash = hash_file(filename)
+                except OSError:
+                    continue
+                cur = self._conn.execute(
+                    "INSERT OR IGNORE INTO prompts (image_hash, prompt_key, description, filename, created) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (image_hash, prompt_key, row["Prompt"], filename, time.time())
+                )
+                imported += cur.rowcount
+            self._conn.commit()
+        return imported
+
+    def compact(self, keep_prompt_key=None):
+        """Optionally drops entries made with other instructions/models, then reclaims space."""
+        removed = 0
+        with self._lock:
+            if keep_prompt_key:
+                cur = self._conn.execute("DELETE FROM prompts WHERE prompt_key != ?", (keep_prompt_key,))
+                removed = cur.rowcount
+                self._conn.commit()
+            self._conn.execute("VACUUM")
+        return removed
+
+    def stats(self):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT prompt_key, COUNT(*) FROM prompts GROUP BY prompt_key ORDER BY COUNT(*) DESC"
+            ).fetchall()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or compact the reimagine prompt cache.")
+    parser.add_argument("command", choices=["stats", "compact"])
+    parser.add_argument("--cache", default=DEFAULT_CACHE_FILE)
+    parser.add_argument("--keep-key", help="compact: delete entries for every other prompt key")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.cache):
+        print(f"No cache found at {args.cache}")
+        sys.exit(1)
+
+    cache = PromptCache(args.cache)
+    if args.command == "stats":
+        print(f"{len(cache)} cached descriptions in {args.cache}")
+        for prompt_key, count in cache.stats():
+            print(f"  {prompt_key}: {count}")
+    else:
+        size_before = os.path.getsize(args.cache)
+        removed = cache.compact(args.keep_key)
+        print(f"Removed {removed} entries. {size_before} -> {os.path.getsize(args.cache)} bytes")
+    cache.close()
+
+if __name__ == "__main__":
+    main()
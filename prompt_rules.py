@@ -0,0 +1,170 @@
+import os
+import re
+import csv
+import sys
+import json
+import time
+import argparse
+from prompt_cache import PromptCache, DEFAULT_CACHE_FILE
+
+# =================================================================================
+#  PROMPT SWAP RULES
+#  Keyword swaps compiled once into a single regex trie, so a prompt is rewritten
+#  in one left-to-right pass however many rules there are. At each position the
+#  longest matching target wins, and text that already reads like a replacement
+#  is left alone: "hat" -> "silly hat" never turns "silly hat" into
+#  "silly silly hat", and a swapped word is never swapped again by a later rule.
+#
+#  Rules file: one "target => replacement" per line (# comments), or a JSON list
+#  of [target, replacement] pairs.
+#
+#  python prompt_rules.py test swaps.txt "A man in a hat"
+#  python prompt_rules.py rewrite swaps.txt --out swapped.csv   (whole prompt cache, no LLM)
+# =================================================================================
+
+def _trie_pattern(words):
+    """Regex matching any of `words`, built as a character trie so the engine never
+    re-scans shared prefixes. Optional tails are greedy, so longer words win."""
+    trie = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[""] = None  # End of a word
+
+    def build(node):
+        branches = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        if "" in node:
+            body = f"(?:{body})?"
+        return body
+
+    return build(trie)
+
+class SwapRules:
+    def __init__(self, rules, whole_words=True):
+        """rules: (target, replacement) pairs, matched case-insensitively. A repeated target keeps
+        its last replacement. whole_words stops "hat" from matching inside "that"."""
+        self.swaps = {}
+        for target, replacement in rules:
+            target = target.strip().lower()
+            if target:
+                self.swaps[target] = replacement
+        # Replacement text maps to itself, so it can't be matched again by a shorter target
+        lookup = {r.lower(): None for r in self.swaps.values() if r.strip() and r.lower() not in self.swaps}
+        lookup.update(self.swaps)
+        self._lookup = lookup
+        self._regex = None
+        if lookup:
+            pattern = _trie_pattern(lookup)
+            if whole_words:
+                pattern = rf"(?<!\w){pattern}(?!\w)"
+            self._regex = re.compile(pattern, re.IGNORECASE)
+
+    def __len__(self):
+        return len(self.swaps)
+
+    def subn(self, text):
+        """(rewritten text, number of swaps made)."""
+        if self._regex is None or not text:
+            return text, 0
+        swapped = 0
+
+        def replace(match):
+            nonlocal swapped
+            replacement = self._lookup.get(match.group(0).lower())
+            if replacement is None:
+                return match.group(0)
+            swapped += 1
+            return replacement
+
+        return self._regex.sub(replace, text), swapped
+
+    def sub(self, text):
+        return self.subn(text)[0]
+
+def load_rules(path):
+    """(target, replacement) pairs from a rules file. Raises ValueError on a malformed line."""
+    with open(path, 'r', encoding='utf-8') as f:
+        content = f.read()
+    if path.lower().endswith(".json"):
+        data = json.loads(content)
+        pairs = data.items() if isinstance(data, dict) else data
+        try:
+            return [(str(target), str(replacement)) for target, replacement in pairs]
+        except (TypeError, ValueError):
+            raise ValueError(f"{path}: expected a list of [target, replacement] pairs")
+
+    rules = []
+    for line_no, line in enumerate(content.splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if "=>" not in line:
+            raise ValueError(f"{path}:{line_no}: expected 'target => replacement'")
+        target, replacement = (part.strip() for part in line.split("=>", 1))
+        if not target:
+            raise ValueError(f"{path}:{line_no}: empty target")
+        rules.append((target, replacement))
+    return rules
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply keyword swap rules to text or to the whole prompt cache.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    test = sub.add_parser("test", help="Rewrite one piece of text")
+    test.add_argument("rules")
+    test.add_argument("text")
+    rewrite = sub.add_parser("rewrite", help="Rewrite every cached description (no LLM calls)")
+    rewrite.add_argument("rules")
+    rewrite.add_argument("--cache", default=DEFAULT_CACHE_FILE)
+    rewrite.add_argument("--key", help="Only descriptions made with this prompt key (see prompt_cache.py stats)")
+    rewrite.add_argument("--out", help="Write Filename,Prompt rows of the rewritten descriptions here")
+    rewrite.add_argument("--show", type=int, default=3, help="Print this many changed descriptions")
+    for p in (test, rewrite):
+        p.add_argument("--substrings", action="store_true", help="Also match inside words (old behaviour)")
+    args = parser.parse_args()
+
+    try:
+        rules = SwapRules(load_rules(args.rules), whole_words=not args.substrings)
+    except (OSError, ValueError) as e:
+        print(f"[!] {e}")
+        sys.exit(1)
+
+    if args.command == "test":
+        text, swapped = rules.subn(args.text)
+        print(text)
+        print(f"({swapped} swaps, {len(rules)} rules)")
+        return
+
+    if not os.path.exists(args.cache):
+        print(f"No cache found at {args.cache}")
+        sys.exit(1)
+    cache = PromptCache(args.cache)
+    entries = cache.entries(args.key)
+    cache.close()
+
+    start = time.perf_counter()
+    rows, changed, total = [], 0, 0
+    for image_hash, prompt_key, description, filename in entries:
+        text, swapped = rules.subn(description)
+        if swapped:
+            changed += 1
+            total += swapped
+            if changed <= args.show:
+                print(f"--- {filename or image_hash}\n{text}\n")
+        rows.append((filename or image_hash, text))
+    elapsed = time.perf_counter() - start
+
+    print(f"{len(entries)} descriptions, {changed} changed, {total} swaps with {len(rules)} rules "
+          f"in {elapsed:.2f}s")
+    if args.out:
+        with open(args.out, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(["Filename", "Prompt"])
+            writer.writerows(rows)
+        print(f"Rewritten prompts -> {args.out}")
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,48 @@
 import os
 import random
 import string
+import wave
+import shutil
+import tempfile
+import subprocess
+import numpy as np
 from collections import Counter
-from moviepy.editor import VideoFileClip, CompositeVideoClip, ColorClip, concatenate_videoclips
+from concurrent.futures import ThreadPoolExecutor
+from moviepy.config import get_setting
+from moviepy.editor import VideoFileClip, AudioFileClip, CompositeVideoClip, ColorClip, concatenate_videoclips
+from moviepy.video.io.ffmpeg_writer import FFMPEG_VideoWriter
+from video_probe import ProbeCache
+from pipeline_metrics import Metrics
+
+# ================= CONFIGURATION =================
+# "compose": open every clip and let MoviePy composite the whole timeline (original behaviour)
+# "stream":  probe metadata first, then decode, letterbox and encode one clip at a time,
+#            so memory and open file handles stay flat no matter how many clips there are
+# "copy":    stream-copy every clip that already matches the target format (ffmpeg concat
+#            demuxer) and re-encode only the odd ones out; falls back to "stream" if needed
+# "segments": normalize every clip to an identical H.264/AAC intermediate in parallel,
+#            then join them by stream copy (best when few clips already match)
+CONCAT_MODE = "copy"
+
+# Parallel ffmpeg encodes for re-encoded clips ("copy" and "segments" modes).
+# CPU threads are split evenly between them.
+ENCODE_WORKERS = os.cpu_count() or 1
+
+# Clip metadata is cached by path + size + mtime, so repeat runs skip the container opens
+PROBE_CACHE_FILE = "video_probe_cache.db"
+AUDIO_FPS = 44100
+AUDIO_CHANNELS = 2
+
+# Encoders used to make odd clips match the stream-copied majority
+VIDEO_ENCODERS = {"h264": "libx264", "hevc": "libx265"}
+AUDIO_ENCODERS = {"aac": "aac", "mp3": "libmp3lame"}
+H264_PROFILES = {"Constrained Baseline": "baseline", "Baseline": "baseline", "Main": "main", "High": "high"}
+
+METRICS_FILE = "concat_metrics.jsonl"  # Per-clip stage timings (None to disable)
+METRICS_PROM_FILE = None               # e.g. a node_exporter textfile-collector path ending in .prom
+# =================================================
+
+metrics = Metrics("concat", METRICS_FILE, METRICS_PROM_FILE)
 
 def get_random_filename(extension=".mp4"):
     """Generates a random filename like 'Result_X7Z2.mp4'."""
@@ -32,36 +72,314 @@ def fit_to_canvas(clip, target_w, target_h):
     
     return final
 
-def main():
-    # 1. Get all mp4 files in current directory
-    files = [f for f in os.listdir('.') if f.lower().endswith('.mp4')]
+def choose_target(infos):
+    """Most common aspect ratio and FPS, and the largest resolution within that aspect ratio."""
+    # Round AR to 2 decimals to group similar ratios (e.g. 1.77 vs 1.78)
+    aspect_ratios = [round(i["width"] / i["height"], 2) for i in infos]
+    most_common_ar = Counter(aspect_ratios).most_common(1)[0][0]
+    print(f"Most common Aspect Ratio detected: {most_common_ar}")
+
+    # Detect most common FPS (rounded to 3 decimals to group 23.976 etc.)
+    # We prioritize the most frequent FPS to avoid upscaling bulk 30fps content to 60fps 
+    # just because of one outlier, or vice versa.
+    rounded_fps = [round(i["fps"], 3) for i in infos]
+    most_common_fps = Counter(rounded_fps).most_common(1)[0][0]
+    print(f"Most common FPS detected: {most_common_fps}")
+
+    # We look for the maximum resolution among videos that match the most common AR.
+    target_w, target_h = 0, 0
+    for info in infos:
+        ar = round(info["width"] / info["height"], 2)
+        if ar == most_common_ar:
+            if info["width"] > target_w:
+                target_w = info["width"]
+                target_h = info["height"]
     
-    if not files:
-        print("No MP4 files found in the current directory.")
+    print(f"Target Resolution set to: {target_w}x{target_h}")
+    return target_w, target_h, most_common_fps
+
+def fit_size(w, h, target_w, target_h):
+    """Size of a clip scaled to fit inside the target (same rule as fit_to_canvas)."""
+    if w / h > target_w / target_h:
+        return target_w, min(target_h, int(round(h * target_w / w)))
+    return min(target_w, int(round(w * target_h / h))), target_h
+
+def frame_count(duration, fps):
+    """Number of frames iter_frames() yields for a clip, used to keep audio in sync."""
+    return len(np.arange(0, duration, 1.0 / fps))
+
+def write_audio_track(infos, fps, wav_path):
+    """Streams each clip's audio (or silence) into one WAV, trimmed/padded to its video length."""
+    with wave.open(wav_path, 'wb') as wav:
+        wav.setnchannels(AUDIO_CHANNELS)
+        wav.setsampwidth(2)
+        wav.setframerate(AUDIO_FPS)
+
+        for info in infos:
+            needed = int(round(frame_count(info["duration"], fps) * AUDIO_FPS / fps))
+            written = 0
+            if info["audio_codec"]:
+                audio = None
+                try:
+                    audio = AudioFileClip(info["path"], fps=AUDIO_FPS)
+                    for chunk in audio.iter_chunks(chunksize=AUDIO_FPS, fps=AUDIO_FPS, quantize=True, nbytes=2):
+                        if chunk.ndim == 1:
+                            chunk = chunk[:, None]
+                        if chunk.shape[1] != AUDIO_CHANNELS:
+                            chunk = np.repeat(chunk[:, :1], AUDIO_CHANNELS, axis=1)
+                        chunk = chunk[:needed - written]
+                        wav.writeframes(chunk.astype("<i2").tobytes())
+                        written += len(chunk)
+                        if written >= needed:
+                            break
+                except Exception as e:
+                    print(f"Audio unreadable in {info['path']}, using silence: {e}")
+                finally:
+                    if audio is not None:
+                        audio.close()
+            if written < needed:
+                wav.writeframes(bytes(2 * AUDIO_CHANNELS * (needed - written)))
+
+def write_video_stream(infos, target_w, target_h, fps, video_path):
+    """Decodes, letterboxes and encodes clips one at a time into a single encoder."""
+    writer = FFMPEG_VideoWriter(video_path, (target_w, target_h), fps, codec="libx264", preset="ultrafast")
+    canvas = np.zeros((target_h, target_w, 3), dtype=np.uint8)
+    try:
+        for n, info in enumerate(infos, 1):
+            print(f"  [{n}/{len(infos)}] {info['path']}")
+            clip = VideoFileClip(info["path"], audio=False)
+            try:
+                new_w, new_h = fit_size(clip.w, clip.h, target_w, target_h)
+                if (new_w, new_h) != (clip.w, clip.h):
+                    clip = clip.resize(newsize=(new_w, new_h))
+                x, y = (target_w - new_w) // 2, (target_h - new_h) // 2
+                canvas[:] = 0
+                # Same frame times write_audio_track assumed, so audio and video stay in sync
+                last_t = max(0.0, clip.duration - 1.0 / fps)
+                for t in np.arange(0, info["duration"], 1.0 / fps):
+                    frame = clip.get_frame(min(t, last_t))
+                    canvas[y:y + new_h, x:x + new_w] = frame[:new_h, :new_w, :3]
+                    writer.write_frame(canvas)
+            finally:
+                clip.close()
+    finally:
+        writer.close()
+
+def concat_streaming(files, output_filename):
+    infos = probe_all(files)
+
+    if not infos:
+        print("No valid clips to process.")
         return
 
-    print(f"Found {len(files)} videos. Analyzing aspect ratios and framerates...")
+    target_w, target_h, fps = choose_target(infos)
 
-    # 2. Shuffle the order
-    random.shuffle(files)
+    ffmpeg = get_setting("FFMPEG_BINARY")
+    work_dir = tempfile.mkdtemp(prefix="concat_", dir=".")
+    try:
+        wav_path = os.path.join(work_dir, "audio.wav")
+        video_path = os.path.join(work_dir, "video.mp4")
 
-    aspect_ratios = []
-    frame_rates = []
-    
+        print("Writing audio track...")
+        with metrics.span("audio_track"):
+            write_audio_track(infos, fps, wav_path)
+
+        print(f"Streaming {len(infos)} clips into the encoder at {fps} FPS...")
+        with metrics.span("video_stream"):
+            write_video_stream(infos, target_w, target_h, fps, video_path)
+
+        print(f"Muxing to {output_filename}...")
+        with metrics.span("mux", output_filename):
+            subprocess.run(
+                [ffmpeg, "-y", "-loglevel", "error", "-i", video_path, "-i", wav_path,
+                 "-map", "0:v:0", "-map", "1:a:0", "-c:v", "copy", "-c:a", "aac", "-shortest", output_filename],
+                check=True
+            )
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def format_signature(info):
+    """Everything that must match for two clips to be joined by stream copy."""
+    return (
+        info["width"], info["height"], round(info["fps"], 3), info["codec"], info["profile"],
+        info["pix_fmt"], info["audio_codec"], info["sample_rate"], info["channels"],
+    )
+
+def normalize_clip(info, target, out_path, ffmpeg, threads=0):
+    """Re-encodes one clip to the target format so it can be joined to the others by stream copy."""
+    w, h = target["width"], target["height"]
+    cmd = [ffmpeg, "-y", "-loglevel", "error", "-i", info["path"]]
+    if target["audio_codec"] and not info["audio_codec"]:
+        layout = "mono" if target["channels"] == 1 else "stereo"
+        cmd += ["-f", "lavfi", "-i", f"anullsrc=r={target['sample_rate']}:cl={layout}"]
+
+    cmd += [
+        "-vf", f"scale={w}:{h}:force_original_aspect_ratio=decrease,pad={w}:{h}:(ow-iw)/2:(oh-ih)/2:black,"
+               f"setsar=1,fps={target['fps']},format={target['pix_fmt']}",
+        "-map", "0:v:0",
+        # ultrafast would force Constrained Baseline; veryfast honours the target's profile
+        "-c:v", VIDEO_ENCODERS[target["codec"]], "-preset", "veryfast", "-threads", str(threads),
+    ]
+    if target["codec"] == "h264" and target["profile"] in H264_PROFILES:
+        cmd += ["-profile:v", H264_PROFILES[target["profile"]]]
+    if target["timescale"]:
+        cmd += ["-video_track_timescale", str(target["timescale"])]
+
+    if target["audio_codec"]:
+        cmd += ["-map", "0:a:0" if info["audio_codec"] else "1:a:0", "-shortest",
+                "-c:a", AUDIO_ENCODERS[target["audio_codec"]],
+                "-ar", str(target["sample_rate"]), "-ac", str(target["channels"])]
+    else:
+        cmd += ["-an"]
+    if info["duration"]:
+        cmd += ["-t", f"{info['duration']:.3f}"]
+    cmd.append(out_path)
+    subprocess.run(cmd, check=True)
+
+def encode_segments(jobs, target, work_dir, ffmpeg):
+    """Normalizes (index, info) jobs with ENCODE_WORKERS parallel ffmpeg processes.
+    Returns {index: segment path}; clips that fail to encode are left out."""
+    if not jobs:
+        return {}
+    workers = max(1, min(ENCODE_WORKERS, len(jobs)))
+    threads = max(1, (os.cpu_count() or 1) // workers)
+
+    def encode(job):
+        n, info = job
+        out_path = os.path.abspath(os.path.join(work_dir, f"seg_{n:05d}.mp4"))
+        with metrics.span("encode", info["path"], duration=info.get("duration")):
+            normalize_clip(info, target, out_path, ffmpeg, threads)
+        return n, out_path
+
+    print(f"Re-encoding {len(jobs)} clips with {workers} parallel encoders ({threads} threads each)...")
+    encoded = {}
+    # Each job is its own ffmpeg process, so a thread pool is enough to keep every core busy
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(encode, job): job for job in jobs}
+        for future in futures:
+            n, info = futures[future]
+            try:
+                encoded[n] = future.result()[1]
+                print(f"  Encoded {info['path']}")
+            except subprocess.CalledProcessError as e:
+                print(f"Skipping {info['path']}: re-encode failed ({e})")
+    return encoded
+
+def join_segments(segments, output_filename, work_dir, ffmpeg):
+    """Joins identically-encoded segments with the ffmpeg concat demuxer (no re-encode)."""
+    list_path = os.path.join(work_dir, "concat.txt")
+    with open(list_path, 'w', encoding='utf-8') as f:
+        for seg in segments:
+            escaped = seg.replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+
+    print(f"Joining {len(segments)} segments into {output_filename} (stream copy)...")
+    with metrics.span("join", output_filename, segments=len(segments)):
+        subprocess.run(
+            [ffmpeg, "-y", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", list_path,
+             "-c", "copy", "-movflags", "+faststart", output_filename],
+            check=True
+        )
+
+def probe_all(files):
+    """Metadata for every readable clip with a known duration, in the (shuffled) order given."""
+    cache = ProbeCache(PROBE_CACHE_FILE)
+    try:
+        with metrics.span("probe", clips=len(files)):
+            results = cache.probe_many(files, workers=ENCODE_WORKERS)
+        metrics.count("probe_cache_hits", cache.hits)
+        if cache.hits:
+            print(f"Metadata for {cache.hits} clips loaded from {PROBE_CACHE_FILE}")
+    finally:
+        cache.close()
+    infos = []
+    for f in files:
+        info = results.get(f)
+        if info is None:
+            continue
+        if not info.get("duration") and info.get("frame_count") and info.get("fps"):
+            # Some containers only report a frame count
+            info["duration"] = info["frame_count"] / info["fps"]
+        if not info.get("duration"):
+            print(f"[!] Skipping {f}: no duration in its metadata")
+            continue
+        infos.append(info)
+    return infos
+
+def concat_segments(files, output_filename):
+    infos = probe_all(files)
+    if not infos:
+        print("No valid clips to process.")
+        return
+
+    target_w, target_h, fps = choose_target(infos)
+    # A fixed intermediate format, so every segment is identical regardless of its source
+    target = {
+        "width": target_w, "height": target_h, "fps": fps, "codec": "h264", "profile": "High",
+        "pix_fmt": "yuv420p", "timescale": 90000,
+        "audio_codec": "aac", "sample_rate": AUDIO_FPS, "channels": AUDIO_CHANNELS,
+    }
+
+    ffmpeg = get_setting("FFMPEG_BINARY")
+    work_dir = tempfile.mkdtemp(prefix="concat_", dir=".")
+    try:
+        encoded = encode_segments(list(enumerate(infos)), target, work_dir, ffmpeg)
+        if not encoded:
+            print("No clips could be encoded.")
+            return
+        join_segments([encoded[n] for n in range(len(infos)) if n in encoded], output_filename, work_dir, ffmpeg)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def concat_copy(files, output_filename):
+    infos = probe_all(files)
+
+    if not infos:
+        print("No valid clips to process.")
+        return
+
+    target_w, target_h, fps = choose_target(infos)
+
+    # The copy target is the most common full format among clips with the target geometry
+    same_geometry = [i for i in infos if (i["width"], i["height"], round(i["fps"], 3)) == (target_w, target_h, fps)]
+    if not same_geometry:
+        print("No clip already matches the target resolution and FPS; using streaming mode.")
+        concat_streaming(files, output_filename)
+        return
+    target_sig = Counter(format_signature(i) for i in same_geometry).most_common(1)[0][0]
+    target = next(i for i in same_geometry if format_signature(i) == target_sig)
+
+    if target["codec"] not in VIDEO_ENCODERS or (target["audio_codec"] and target["audio_codec"] not in AUDIO_ENCODERS):
+        print(f"Cannot match {target['codec']}/{target['audio_codec']} when re-encoding; using streaming mode.")
+        concat_streaming(files, output_filename)
+        return
+
+    odd = [i for i in infos if format_signature(i) != target_sig]
+    print(f"Stream-copying {len(infos) - len(odd)} clips; re-encoding {len(odd)} to match "
+          f"{target['codec']} {target_w}x{target_h} @ {fps} FPS")
+
+    ffmpeg = get_setting("FFMPEG_BINARY")
+    work_dir = tempfile.mkdtemp(prefix="concat_", dir=".")
+    try:
+        encoded = encode_segments([(n, i) for n, i in enumerate(infos) if format_signature(i) != target_sig],
+                                  target, work_dir, ffmpeg)
+        segments = []
+        for n, info in enumerate(infos):
+            if format_signature(info) == target_sig:
+                segments.append(os.path.abspath(info["path"]))
+            elif n in encoded:
+                segments.append(encoded[n])
+        join_segments(segments, output_filename, work_dir, ffmpeg)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def concat_compose(files, output_filename):
     # Load clips and gather data
     raw_clips = []
     for f in files:
         try:
             clip = VideoFileClip(f)
             raw_clips.append(clip)
-            
-            # Round AR to 2 decimals to group similar ratios (e.g. 1.77 vs 1.78)
-            ar = round(clip.w / clip.h, 2)
-            aspect_ratios.append(ar)
-            
-            # Collect FPS
-            frame_rates.append(clip.fps)
-            
         except Exception as e:
             print(f"Skipping corrupt file {f}: {e}")
 
@@ -69,30 +387,11 @@ def main():
         print("No valid clips to process.")
         return
 
-    # 3. Find the most common aspect ratio and framerate
-    most_common_ar = Counter(aspect_ratios).most_common(1)[0][0]
-    print(f"Most common Aspect Ratio detected: {most_common_ar}")
-
-    # Detect most common FPS (rounded to 3 decimals to group 23.976 etc.)
-    # We prioritize the most frequent FPS to avoid upscaling bulk 30fps content to 60fps 
-    # just because of one outlier, or vice versa.
-    rounded_fps = [round(f, 3) for f in frame_rates]
-    most_common_fps = Counter(rounded_fps).most_common(1)[0][0]
-    print(f"Most common FPS detected: {most_common_fps}")
+    target_w, target_h, most_common_fps = choose_target(
+        [{"width": c.w, "height": c.h, "fps": c.fps} for c in raw_clips]
+    )
 
-    # 4. Determine Target Resolution
-    # We look for the maximum resolution among videos that match the most common AR.
-    target_w, target_h = 0, 0
-    for clip in raw_clips:
-        ar = round(clip.w / clip.h, 2)
-        if ar == most_common_ar:
-            if clip.w > target_w:
-                target_w = clip.w
-                target_h = clip.h
-    
-    print(f"Target Resolution set to: {target_w}x{target_h}")
-
-    # 5. Process clips (Resize/Letterbox)
+    # Process clips (Resize/Letterbox)
     processed_clips = []
     print("Processing clips (Resizing and Letterboxing)...")
     
@@ -105,13 +404,12 @@ def main():
             processed = fit_to_canvas(clip, target_w, target_h)
             processed_clips.append(processed)
 
-    # 6. Concatenate
+    # Concatenate
     print("Concatenating video... (This may take some time)")
     # method='compose' is necessary when clips have been resized/composited
     final_video = concatenate_videoclips(processed_clips, method="compose")
 
-    # 7. Write Output
-    output_filename = get_random_filename()
+    # Write Output
     print(f"Writing to {output_filename} at {most_common_fps} FPS...")
     
     # Updated to use the detected most_common_fps instead of hardcoded 30
@@ -120,7 +418,32 @@ def main():
     # Cleanup
     for clip in raw_clips:
         clip.close()
+
+def main():
+    # 1. Get all mp4 files in current directory
+    files = [f for f in os.listdir('.') if f.lower().endswith('.mp4')]
+    
+    if not files:
+        print("No MP4 files found in the current directory.")
+        return
+
+    print(f"Found {len(files)} videos. Analyzing aspect ratios and framerates...")
+
+    # 2. Shuffle the order
+    random.shuffle(files)
+
+    output_filename = get_random_filename()
+    if CONCAT_MODE == "copy":
+        concat_copy(files, output_filename)
+    elif CONCAT_MODE == "segments":
+        concat_segments(files, output_filename)
+    elif CONCAT_MODE == "stream":
+        concat_streaming(files, output_filename)
+    else:
+        with metrics.span("compose", output_filename):
+            concat_compose(files, output_filename)
     
+    metrics.close()
     print("Done!")
 
 if __name__ == "__main__":
@@ -1,31 +1,93 @@
 import os
-import json
-import base64
-import requests
 import random
 import csv
-import time
-import io
 import shutil
-import re  # Added for case-insensitive keyword swapping
+import queue
+import threading
+import json
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from tqdm import tqdm
 from PIL import Image
+from comfy_workflow import WorkflowTemplate, WorkflowError
+from comfy_dispatch import ComfyDispatcher
+from prompt_cache import PromptCache, hash_file, make_prompt_key
+from prompt_rules import SwapRules, load_rules
+from phash_index import PerceptualIndex, dhash_image
+from lm_client import VisionClient, LMError, image_message
+from image_prep import ImagePrep
+from pipeline_metrics import Metrics, timed_iter
 
 # ================= CONFIGURATION =================
 LM_STUDIO_URL = "http://192.168.2.192:1234/v1/chat/completions"
-COMFY_URL = "http://127.0.0.1:8188/prompt" 
+# One or more ComfyUI servers; each job goes to the one with the shortest queue
+COMFY_URLS = [
+    "http://127.0.0.1:8188",
+]
 MODEL_ID = "qwen3-vl-8b-instruct-abliterated-v2.0"
 WORKFLOW_FILE = "ZImage_Poster_API.json" 
 LOG_FILE = "reimagine_log.csv"
+CACHE_FILE = "reimagine_cache.db"  # Descriptions keyed by image content + prompt/model
+# How originals are placed next to their renders in reimagine/:
+# "hardlink" or "reflink" (no bytes copied, falls back to "copy"), "copy", or "none"
+ORIGINALS_MODE = "hardlink"
+
+# Workflow injection points: name -> (Node ID, input name)
+WORKFLOW_NODES = {
+    "prompt": ("6", "text"),
+    "seed": ("57", "seed"),
+    "width": ("61", "width"),
+    "height": ("61", "height"),
+    "batch_size": ("61", "batch_size"),
+    "output_prefix": ("73", "filename_prefix"),
+}
+
+# Backpressure: stop submitting once each ComfyUI server holds QUEUE_HIGH_WATERMARK jobs,
+# resume when it has drained to QUEUE_LOW_WATERMARK
+QUEUE_HIGH_WATERMARK = 8
+QUEUE_LOW_WATERMARK = 3
+CANCEL_QUEUED_ON_STOP = True   # Ctrl+C removes our not-yet-started jobs from ComfyUI
+
+# Resolution buckets: (minimum width/height ratio, width, height, label), checked top to
+# bottom against ratio > minimum; keep a 0.0 row last to catch everything else
+RESOLUTION_BUCKETS = [
+    (1.1, 1152, 896, "landscape (4:3)"),
+    (0.9, 1024, 1024, "square (1:1)"),
+    (0.72, 896, 1152, "portrait (3:4)"),
+    (0.0, 832, 1216, "portrait (2:3)"),
+]
+BUCKETS_FILE = "buckets.json"  # Optional override: JSON list of [min_ratio, width, height, label]
+
+# Job order: "random" shuffles everything; "bucketed" groups images by resolution bucket
+# (random bucket order, shuffled within each) so ComfyUI isn't switching latent sizes every job.
+# "bucketed" reads every image header before the run starts, on top of the scan stage's own
+# read of each file; cheap on a local disk, noticeable on network shares.
+ORDER_MODE = "random"
+
+# Variations: several renders per description, so one vision call feeds K images
+VARIATIONS_PER_IMAGE = 1
+# "batch": one job with batch_size=K (one seed, the model stays loaded for a bigger batch)
+# "seeds": K jobs with consecutive seeds, queued back to back
+VARIATION_MODE = "batch"
 
 # Reliability Settings
 LM_TIMEOUT = 120  
-MAX_RETRIES = 2
+MAX_RETRIES = 2  # Retries on timeouts, dropped connections and 5xx, with jittered backoff
+
+DESCRIPTION_PROMPT = "If you think the image is a poster or magazine cover, mention this first! Describe this image in extreme detail for an image generation prompt. Change all of the characters to be wearing a silly hat.  Be creative in your description of the hats. Provide the details and organized image description ONLY as your response, no additional information."
 
 # Clarification Settings
 REQUIRED_KEYWORD = "silly hat" 
 MAX_CLARIFICATIONS = 2 
+# "rewrite": a text-only request asking to revise the previous description (the image isn't re-sent)
+# "image": re-send the whole conversation, image included (slower; the model can look again)
+CLARIFY_MODE = "rewrite"
+KEYWORD_DEADLINE_CHARS = None   # "rewrite": stop a streamed first description that still lacks the
+                                # keyword this many characters in and rewrite that instead (None = off)
+# Stream replies and check for REQUIRED_KEYWORD as the text arrives. Only pays off with a deadline
+# to cut at; without one the whole reply is read either way
+STREAM_DESCRIPTIONS = KEYWORD_DEADLINE_CHARS is not None
+REWRITE_PROMPT = "Below is an image description written as an image generation prompt (it may stop mid-sentence). Rewrite it so that it explicitly includes the {keyword}, keeping every other detail, and finish it if it is cut off. Provide the rewritten description ONLY as your response, no additional information.\n\n{description}"
 
 # --- NEW: Keyword Replacement Settings ---
 ENABLE_SWAPS = True
@@ -36,8 +98,41 @@ KEYWORD_SWAPS = [
     ("wheel", "Toaster"),
     ("hat", "silly hat")
 ]
+# More rules, one "target => replacement" per line (or a JSON list of pairs); used when present
+SWAPS_FILE = "swaps.txt"
+# Whole words/phrases only, so "hat" no longer hits "that"; False matches inside words like before
+SWAP_WHOLE_WORDS = True
+
+# --- Pipeline Settings ---
+# Describe images ahead of the ComfyUI submitter so LM Studio and the GPU overlap
+ENABLE_PIPELINE = True
+LLM_WORKERS = 2           # Concurrent vision requests sent to LM Studio
+PIPELINE_QUEUE_SIZE = 8   # Max finished descriptions waiting for ComfyUI (backpressure)
+PREP_WORKERS = max(1, (os.cpu_count() or 2) // 2)  # Processes resizing/encoding images ahead of the LLM
+PAYLOAD_CACHE_FILE = "vision_payloads.db"          # Encoded images keyed by content hash
+
+# --- Near-Duplicate Detection ---
+# Perceptual hashes catch resized/recompressed copies that the content hash misses
+ENABLE_PHASH = True
+PHASH_FILE = "phash_index.db"
+PHASH_MAX_DISTANCE = 4      # Differing bits (of 64) that still count as the same picture
+NEAR_DUP_ACTION = "reuse"   # "reuse" the earlier description, or "skip" the image
+
+# --- Metrics ---
+METRICS_FILE = "reimagine_metrics.jsonl"  # Per-image stage timings, appended as they happen (None to disable)
+METRICS_PROM_FILE = None                  # e.g. a node_exporter textfile-collector path ending in .prom
 # =================================================
 
+# Cache entries are only reused for the same instruction and model
+PROMPT_KEY = make_prompt_key(DESCRIPTION_PROMPT, MODEL_ID)
+
+metrics = Metrics("reimagine", METRICS_FILE, METRICS_PROM_FILE)
+
+# Shared by every describe worker: pooled connections, retries, latency stats
+lm = VisionClient(LM_STUDIO_URL, MODEL_ID, timeout=LM_TIMEOUT,
+                  max_concurrency=LLM_WORKERS, max_retries=MAX_RETRIES, metrics=metrics)
+prep = ImagePrep(PAYLOAD_CACHE_FILE, PREP_WORKERS)
+
 stop_requested = False
 
 def log_task(filename, ratio, prompt):
@@ -48,202 +143,548 @@ def log_task(filename, ratio, prompt):
             writer.writerow(["Timestamp", "Filename", "Ratio", "Prompt"])
         writer.writerow([datetime.now().strftime("%Y-%m-%d %H:%M:%S"), filename, ratio, prompt])
 
-def load_existing_prompts(log_file):
-    prompts = {}
-    if not os.path.exists(log_file):
-        return prompts
-    try:
-        with open(log_file, 'r', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                if "Filename" in row and "Prompt" in row:
-                    prompts[row["Filename"]] = row["Prompt"]
-    except Exception as e:
-        print(f"[!] Error reading log file: {e}")
-    return prompts
+def process_and_encode_image(image_path, image_hash=None):
+    """Base64 JPEG for the vision model (draft-mode decode, cached by content hash)."""
+    return prep.encode(image_path, image_hash)
 
-def process_and_encode_image(image_path, max_size=768):
-    with Image.open(image_path) as img:
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
-        
-        if max(img.size) > max_size:
-            img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
-        
-        buffered = io.BytesIO()
-        img.save(buffered, format="JPEG", quality=85)
-        return base64.b64encode(buffered.getvalue()).decode('utf-8')
+def build_swap_rules():
+    """KEYWORD_SWAPS (up to NUM_SWAPS) plus SWAPS_FILE, compiled once; file rules win on a repeated target."""
+    rules = list(KEYWORD_SWAPS[:NUM_SWAPS])
+    if SWAPS_FILE and os.path.exists(SWAPS_FILE):
+        try:
+            rules += load_rules(SWAPS_FILE)
+        except (OSError, ValueError) as e:
+            print(f"[!] Ignoring {SWAPS_FILE}: {e}")
+    return SwapRules(rules, SWAP_WHOLE_WORDS)
 
-def get_image_description(image_path):
-    try:
-        base64_image = process_and_encode_image(image_path)
-    except Exception as e:
-        print(f"Error processing image {image_path}: {e}")
-        return None
+# Set up by main() when ENABLE_SWAPS is on
+swap_rules = None
 
-    messages = [
-        {"role": "user", "content": [
-            {"type": "text", "text": "If you think the image is a poster or magazine cover, mention this first! Describe this image in extreme detail for an image generation prompt. Change all of the characters to be wearing a silly hat.  Be creative in your description of the hats. Provide the details and organized image description ONLY as your response, no additional information."},
-            {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}}
-        ]}
-    ]
+def generate_description(messages, allow_cut=False):
+    """One description turn. Returns (text, has_keyword, cut). When streaming, REQUIRED_KEYWORD is
+    looked for as text arrives; with allow_cut and KEYWORD_DEADLINE_CHARS a reply still missing it
+    that far in is stopped early."""
+    keyword = REQUIRED_KEYWORD.lower() if REQUIRED_KEYWORD else None
+    if not STREAM_DESCRIPTIONS:
+        text = lm.chat(messages, temperature=0.7)
+        return text, keyword is None or keyword in text.lower(), False
 
-    total_loops = 1 + (MAX_CLARIFICATIONS if REQUIRED_KEYWORD else 0)
-    current_description = None
+    state = {}
 
-    for loop_index in range(total_loops):
-        payload = {
-            "model": MODEL_ID,
-            "messages": messages,
-            "temperature": 0.7
-        }
+    def watch(text):
+        if not text:
+            # A new attempt: a reply that dropped mid-stream is retried from scratch
+            state.update(found=keyword is None, cut=False, checked=0)
+            return False
+        if state["found"]:
+            return False
+        # Only the new tail is searched, with enough overlap for a keyword split across chunks
+        if keyword in text[max(0, state["checked"] - len(keyword)):].lower():
+            state["found"] = True
+            return False
+        state["checked"] = len(text)
+        if allow_cut and KEYWORD_DEADLINE_CHARS and len(text) >= KEYWORD_DEADLINE_CHARS:
+            state["cut"] = True
+            return True
+        return False
 
-        success = False
-        for attempt in range(MAX_RETRIES + 1):
-            try:
-                response = requests.post(LM_STUDIO_URL, json=payload, timeout=LM_TIMEOUT)
-                response.raise_for_status()
-                current_description = response.json()['choices'][0]['message']['content'].strip()
-                success = True
-                break
-            except requests.exceptions.Timeout:
-                print(f"\n[!] Timeout on {image_path} (Net Attempt {attempt+1})")
-                if attempt < MAX_RETRIES:
-                    time.sleep(1)
-            except Exception as e:
-                print(f"\n[!] LM Studio Error: {e}")
-                break
-        
-        if not success:
+    text = lm.chat_stream(messages, on_text=watch, temperature=0.7)
+    return text, state["found"], state["cut"]
+
+def get_image_description(image_path, base64_image=None, image_hash=None):
+    if base64_image is None:
+        try:
+            base64_image = process_and_encode_image(image_path, image_hash)
+        except Exception as e:
+            print(f"Error processing image {image_path}: {e}")
             return None
 
-        if not REQUIRED_KEYWORD:
-            return current_description
+    messages = [image_message(DESCRIPTION_PROMPT, base64_image)]
+    rewrite = CLARIFY_MODE == "rewrite"
+    try:
+        description, found, cut = generate_description(messages, allow_cut=rewrite and MAX_CLARIFICATIONS > 0)
+    except LMError as e:
+        print(f"\n[!] LM Studio Error on {image_path}: {e}")
+        return None
+    if found:
+        metrics.count("keyword_first_pass")
+        return description
+    if cut:
+        metrics.count("keyword_cutoffs")
 
-        if REQUIRED_KEYWORD.lower() in current_description.lower():
-            return current_description 
-        
-        if loop_index < total_loops - 1:
-            print(f"\n[?] Missing '{REQUIRED_KEYWORD}'. Asking for clarification (Attempt {loop_index+1}/{MAX_CLARIFICATIONS})...")
-            messages.append({"role": "assistant", "content": current_description})
+    for attempt in range(MAX_CLARIFICATIONS):
+        print(f"\n[?] Missing '{REQUIRED_KEYWORD}'. Asking for clarification (Attempt {attempt+1}/{MAX_CLARIFICATIONS})...")
+        metrics.count("clarifications")
+        if rewrite:
+            # The description already carries what the model saw, so a text-only turn is enough
+            messages = [{"role": "user", "content": REWRITE_PROMPT.format(keyword=REQUIRED_KEYWORD, description=description)}]
+        else:
+            messages.append({"role": "assistant", "content": description})
             messages.append({
                 "role": "user", 
                 "content": f"You missed a key detail. The image definitely contains a {REQUIRED_KEYWORD}. Please rewrite the description and ensure you explicitly include the {REQUIRED_KEYWORD}."
             })
-        else:
-            print(f"\n[!] Warning: '{REQUIRED_KEYWORD}' still missing after max retries. Using last result.")
+        try:
+            with metrics.span(f"clarify_{CLARIFY_MODE}", image_path):
+                description, found, _ = generate_description(messages)
+        except LMError as e:
+            print(f"\n[!] LM Studio Error on {image_path}: {e}")
+            return None
+        if found:
+            metrics.count(f"keyword_after_{CLARIFY_MODE}")
+            return description
+
+    print(f"\n[!] Warning: '{REQUIRED_KEYWORD}' still missing after max retries. Using last result.")
+    metrics.count("keyword_missing")
+    return description
 
-    return current_description
+def load_buckets(path, default):
+    """Bucket table from a JSON file if present, else the one in the config section."""
+    if not path or not os.path.exists(path):
+        return default
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            rows = [(float(r[0]), int(r[1]), int(r[2]), str(r[3])) for r in json.load(f)]
+    except (OSError, ValueError, TypeError, IndexError) as e:
+        print(f"[!] Ignoring {path}: {e}")
+        return default
+    if not rows:
+        return default
+    return sorted(rows, key=lambda r: r[0], reverse=True)
+
+def bucket_for_size(w, h):
+    ratio = w / h
+    for min_ratio, width, height, label in RESOLUTION_BUCKETS:
+        if ratio > min_ratio:
+            return width, height, label
+    _, width, height, label = RESOLUTION_BUCKETS[-1]
+    return width, height, label
+
+def read_sizes(files, workers=8):
+    """Header-only size of every image ({file: (w, h) or None}), read in parallel."""
+    def size_of(path):
+        try:
+            with Image.open(path) as img:
+                return path, img.size
+        except Exception:
+            return path, None
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return dict(pool.map(size_of, files))
+
+def order_files(files, mode=None, sizes=None):
+    """Job order for a run; see ORDER_MODE."""
+    mode = mode or ORDER_MODE
+    ordered = list(files)
+    random.shuffle(ordered)
+    if mode != "bucketed":
+        return ordered
+
+    sizes = sizes if sizes is not None else read_sizes(ordered)
+    groups = {}
+    for f in ordered:
+        size = sizes.get(f)
+        key = bucket_for_size(*size)[:2] if size else None
+        groups.setdefault(key, []).append(f)
+    # Unreadable images last; they fail fast in the scan stage anyway
+    keys = [k for k in groups if k is not None]
+    random.shuffle(keys)
+    if None in groups:
+        keys.append(None)
+    return [f for k in keys for f in groups[k]]
 
 def get_smart_dimensions(image_path):
     with Image.open(image_path) as img:
-        w, h = img.size
-        ratio = w / h
-        
-        if ratio > 1.1: 
-            return 1152, 896, "landscape (4:3)"
-        elif ratio > 0.9:
-            return 1024, 1024, "square (1:1)"
-        elif ratio > 0.72:
-            return 896, 1152, "portrait (3:4)"
-        else:
-            return 832, 1216, "portrait (2:3)"
+        return bucket_for_size(*img.size)
 
-def send_to_comfy(prompt_text, width, height, output_prefix):
+def _reflink(src, dst):
+    """Copy-on-write clone (Btrfs, XFS, ...). False where unsupported, e.g. on Windows or NTFS/ext4."""
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    FICLONE = 0x40049409
     try:
-        with open(WORKFLOW_FILE, 'r') as f:
-            workflow = json.load(f)
+        with open(src, 'rb') as s, open(dst, 'wb') as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+    except OSError:
+        if os.path.exists(dst):
+            os.remove(dst)
+        return False
+    shutil.copystat(src, dst)
+    return True
+
+def place_original(src, dst, mode=ORIGINALS_MODE):
+    """Puts the original next to its render without re-reading it when the filesystem allows."""
+    if mode == "none":
+        return
+    if os.path.exists(dst):
+        if os.path.samefile(src, dst):
+            return
+        os.remove(dst)
+    if mode == "hardlink":
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass  # Other volume or no link support; copy instead
+    elif mode == "reflink" and _reflink(src, dst):
+        return
+    shutil.copy2(src, dst)
+
+class ComfySubmitter:
+    """Renders jobs from the workflow template and queues them on the least-loaded ComfyUI server."""
 
-        if isinstance(workflow, list) or "nodes" in workflow:
-            print(f"[!] FATAL: {WORKFLOW_FILE} is in 'Saved' format.")
+    def __init__(self, template, dispatcher):
+        self.template = template
+        self.dispatcher = dispatcher
+
+    def send(self, prompt_text, width, height, output_prefix, seed=None, batch_size=1):
+        try:
+            values = dict(
+                prompt=str(prompt_text),
+                seed=seed if seed is not None else random.randint(1, 10**15),
+                width=width,
+                height=height,
+                output_prefix=output_prefix,
+            )
+            if batch_size > 1:
+                values["batch_size"] = batch_size
+            workflow = self.template.render(**values)
+
+            # Blocks while ComfyUI is saturated; the LLM stages back up behind the bounded job queue
+            with metrics.span("backpressure_wait"):
+                has_room = self.dispatcher.wait_for_capacity(
+                    QUEUE_HIGH_WATERMARK, QUEUE_LOW_WATERMARK, should_stop=lambda: stop_requested
+                )
+            if not has_room:
+                return False
+
+            with metrics.span("comfy_submit", output_prefix):
+                endpoint, _ = self.dispatcher.submit(workflow)
+            return endpoint is not None
+        except Exception as e:
+            print(f"[!] ComfyUI Error: {e}")
             return False
 
-        if "6" in workflow: 
-            workflow["6"]["inputs"]["text"] = str(prompt_text)
-        if "57" in workflow:
-            workflow["57"]["inputs"]["seed"] = random.randint(1, 10**15)
-        if "61" in workflow:
-            workflow["61"]["inputs"]["width"] = width
-            workflow["61"]["inputs"]["height"] = height
-        if "73" in workflow:
-            workflow["73"]["inputs"]["filename_prefix"] = output_prefix
-
-        response = requests.post(COMFY_URL, json={"prompt": workflow}, timeout=15)
-        return response.status_code == 200
+    def send_variations(self, prompt_text, width, height, output_prefix, count, mode=VARIATION_MODE):
+        """Queues `count` renders of one description and returns how many were accepted.
+        Each job's files are named after its seed (<prefix>_s<seed>), so reruns are predictable."""
+        if count <= 1:
+            return int(self.send(prompt_text, width, height, output_prefix))
+
+        base_seed = random.randint(1, 10**15)
+        if mode == "batch" and self.template.has("batch_size"):
+            ok = self.send(prompt_text, width, height, f"{output_prefix}_s{base_seed}", base_seed, batch_size=count)
+            return count if ok else 0
+
+        accepted = 0
+        for i in range(count):
+            seed = base_seed + i
+            accepted += self.send(prompt_text, width, height, f"{output_prefix}_s{seed}", seed)
+        return accepted
+
+# Returned by DescriptionSource.get for images deliberately left out (already reported)
+SKIPPED = object()
+
+class DescriptionSource:
+    """Finds a description for an image: exact cache hit, near-duplicate, or a fresh LLM call."""
+
+    def __init__(self, cache, use_cache, near_dups=None, cached_only=False):
+        """cached_only re-queues cached descriptions and skips everything else, so no LLM calls are made."""
+        self.cache = cache
+        self.use_cache = use_cache or cached_only
+        self.near_dups = near_dups
+        self.cached_only = cached_only
+
+    def skip_hashes(self):
+        """Images the scan stage needn't build a vision payload for: those already described,
+        or every image (None) when only cached descriptions are used."""
+        if self.cached_only:
+            return None
+        return self.cache.hashes(PROMPT_KEY) if self.use_cache else frozenset()
+
+    def get(self, filename, image_hash=None, payload=None, phash=None):
+        """payload/image_hash/phash come from the prep stage when it has already read the file.
+        Returns the description, None on failure, or SKIPPED."""
+        if image_hash is None:
+            try:
+                image_hash = hash_file(filename)
+            except OSError as e:
+                print(f"\n[!] Error reading {filename}: {e}")
+                return None
+
+        if self.use_cache:
+            description = self.cache.get(image_hash, PROMPT_KEY)
+            if description:
+                metrics.count("prompt_cache_hits")
+                return description
+        if self.cached_only:
+            metrics.count("not_cached")
+            print(f"\n[=] Skipping {filename}: no cached description")
+            return SKIPPED
+
+        if self.near_dups is not None:
+            if phash is None:
+                try:
+                    phash = dhash_image(filename)
+                except Exception as e:
+                    print(f"\n[!] Could not hash {filename}: {e}")
+            match = self.near_dups.find(phash) if phash is not None else None
+            if match:
+                metrics.count("near_duplicates")
+                if NEAR_DUP_ACTION == "skip":
+                    print(f"\n[=] Skipping {filename}: near-duplicate of an image already described")
+                    return SKIPPED
+                description = match[0]
+                self.cache.put(image_hash, PROMPT_KEY, description, filename)
+                return description
+
+        with metrics.span("vision", filename):
+            description = get_image_description(filename, payload, image_hash)
+        if description:
+            # Stored before swaps so new swap rules can be applied to old descriptions
+            self.cache.put(image_hash, PROMPT_KEY, description, filename)
+            if phash is not None:
+                self.near_dups.add(phash, description, filename)
+        return description
+
+def prepare_job(scanned, output_dir, source):
+    """Gets a description, places the original and works out the render settings for one scanned image."""
+    filename = scanned.path
+    description = source.get(filename, scanned.image_hash, scanned.payload, scanned.phash)
+    if description is SKIPPED:
+        return None
+    if not description:
+        print(f"\n[!] Could not get description for {filename}")
+        return None
+
+    # Only images that will actually be rendered get their original placed
+    try:
+        with metrics.span("place_original", filename):
+            place_original(filename, os.path.join(output_dir, filename))
     except Exception as e:
-        print(f"[!] ComfyUI Error: {e}")
-        return False
+        print(f"\n[!] Error copying original file {filename}: {e}")
 
-def main():
+    # --- KEYWORD SWAP LOGIC (The Last Step) ---
+    if swap_rules is not None:
+        # Every rule in one pass; swapped text is never swapped again
+        description, swapped = swap_rules.subn(description)
+        if swapped:
+            metrics.count("keyword_swaps", swapped)
+    # ------------------------------------------
+        
+    # The scan stage already read the header; reopen only if it couldn't
+    w, h, ratio_desc = bucket_for_size(*scanned.size) if scanned.size else get_smart_dimensions(filename)
+    base_name = os.path.splitext(filename)[0]
+    return {
+        "filename": filename,
+        "description": description,
+        "width": w,
+        "height": h,
+        "ratio_desc": ratio_desc,
+        "output_prefix": f"{output_dir}/{base_name}_reimagined",
+    }
+
+def submit_job(submitter, job):
+    accepted = submitter.send_variations(
+        job["description"], job["width"], job["height"], job["output_prefix"], VARIATIONS_PER_IMAGE
+    )
+    if 0 < accepted < VARIATIONS_PER_IMAGE:
+        print(f"\n[!] ComfyUI accepted {accepted}/{VARIATIONS_PER_IMAGE} renders for {job['filename']}")
+    if accepted:
+        log_task(job["filename"], f"{job['width']}x{job['height']} ({job['ratio_desc']})", job["description"])
+    else:
+        print(f"\n[!] Failed to queue {job['filename']} to ComfyUI")
+
+def run_sequential(submitter, files, output_dir, source):
     global stop_requested
+    # The scan stage (hash, size, payload in one read) still runs a couple of images ahead
+    scanned_images = prep.iter_prepared(files, skip_hashes=source.skip_hashes(), phash=source.near_dups is not None)
+    try:
+        # Ctrl+C can land while waiting on the prep pool as well as mid-job
+        for scanned in tqdm(timed_iter(scanned_images, metrics, "scan_wait"), total=len(files), unit="img"):
+            if stop_requested:
+                break
+            if scanned.error:
+                print(f"\n[!] Error processing image {scanned.path}: {scanned.error}")
+                continue
+
+            job = prepare_job(scanned, output_dir, source)
+            if job:
+                submit_job(submitter, job)
+
+    except KeyboardInterrupt:
+        print("\n[!] Stop signal received. Stopping...")
+        stop_requested = True
+    finally:
+        scanned_images.close()  # Winds the prep pool down now, not whenever it is collected
+
+_WORKER_DONE = object()
+
+def prep_feeder(files, file_queue, num_workers, skip_hashes=frozenset(), phash=False):
+    """Scan stage: reads each image once in a process pool (hash, size, vision payload)
+    and hands the results to the describe workers in order."""
+    try:
+        for scanned in timed_iter(prep.iter_prepared(files, skip_hashes=skip_hashes, phash=phash), metrics, "scan_wait"):
+            if stop_requested:
+                break
+            if scanned.error:
+                print(f"\n[!] Error processing image {scanned.path}: {scanned.error}")
+            while not stop_requested:
+                try:
+                    file_queue.put(scanned, timeout=0.5)
+                    break
+                except queue.Full:
+                    continue
+    finally:
+        # After a stop the workers exit on their own, and the queue may never drain
+        if not stop_requested:
+            for _ in range(num_workers):
+                file_queue.put(_WORKER_DONE)
+
+def describe_worker(file_queue, job_queue, output_dir, source):
+    """Pulls prepared images and pushes finished jobs; blocks when the submitter falls behind."""
+    while not stop_requested:
+        try:
+            item = file_queue.get(timeout=0.5)
+        except queue.Empty:
+            continue
+        if item is _WORKER_DONE:
+            break
+        if item.error:
+            job_queue.put(None)  # Unreadable image; counted as done
+            continue
+        try:
+            job = prepare_job(item, output_dir, source)
+        except Exception as e:
+            print(f"\n[!] Error preparing {item.path}: {e}")
+            job = None
+        job_queue.put(job)
+    job_queue.put(_WORKER_DONE)
+
+def run_pipelined(submitter, files, output_dir, source):
+    global stop_requested
+    num_workers = max(1, LLM_WORKERS)
+    # Bounded so the prep pool stays only a little ahead of the vision workers
+    file_queue = queue.Queue(maxsize=num_workers * 2)
+    job_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+
+    threading.Thread(target=prep_feeder, args=(files, file_queue, num_workers, source.skip_hashes(), source.near_dups is not None), daemon=True).start()
+    workers = [
+        threading.Thread(target=describe_worker, args=(file_queue, job_queue, output_dir, source), daemon=True)
+        for _ in range(num_workers)
+    ]
+    for t in workers:
+        t.start()
+
+    finished = 0
+    with tqdm(total=len(files), unit="img") as pbar:
+        while finished < len(workers):
+            try:
+                try:
+                    # Short timeout keeps Ctrl+C responsive while waiting on the workers
+                    job = job_queue.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+                if job is _WORKER_DONE:
+                    finished += 1
+                    continue
+                if job:
+                    submit_job(submitter, job)
+                pbar.update(1)
+            except KeyboardInterrupt:
+                if stop_requested:
+                    print("\n[!] Second stop signal. Abandoning in-flight descriptions.")
+                    break
+                print("\n[!] Stop signal received. Finishing in-flight descriptions...")
+                stop_requested = True
+
+def main():
+    global RESOLUTION_BUCKETS
     valid_exts = ('.jpg', '.jpeg', '.png', '.webp')
     files = [f for f in os.listdir('.') if f.lower().endswith(valid_exts)]
     
-    random.shuffle(files)
+    RESOLUTION_BUCKETS = load_buckets(BUCKETS_FILE, RESOLUTION_BUCKETS)
+    files = order_files(files)
     
+    # Parse and validate the workflow once; every job renders from this template
+    try:
+        template = WorkflowTemplate.load(WORKFLOW_FILE, WORKFLOW_NODES)
+    except WorkflowError as e:
+        print(f"[!] FATAL: {e}")
+        return
+    if template.missing:
+        print(f"[!] Warning: {WORKFLOW_FILE} has no node for: {', '.join(template.missing)}")
+
+    dispatcher = ComfyDispatcher(COMFY_URLS)
+    submitter = ComfySubmitter(template, dispatcher)
+
     output_dir = "reimagine"
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
     
     print(f"--- PRESS CTRL+C TO CANCEL ---")
-    print(f"Targeting Primary Instance: {COMFY_URL}")
+    print(f"Targeting ComfyUI: {', '.join(COMFY_URLS)}")
     print(f"Clarification Keyword: '{REQUIRED_KEYWORD}'")
     
+    global swap_rules
     if ENABLE_SWAPS:
-        print(f"Keyword Swaps Active: {NUM_SWAPS} rules applied.")
+        swap_rules = build_swap_rules()
+        print(f"Keyword Swaps Active: {len(swap_rules)} rules applied.")
+
+    if ENABLE_PIPELINE:
+        print(f"Pipeline Active: {LLM_WORKERS} vision workers, queue depth {PIPELINE_QUEUE_SIZE}.")
+    print(f"Job Order: {ORDER_MODE} ({len(RESOLUTION_BUCKETS)} resolution buckets)")
+    if VARIATIONS_PER_IMAGE > 1:
+        print(f"Variations: {VARIATIONS_PER_IMAGE} per image ({VARIATION_MODE} mode).")
 
-    cached_prompts = {}
+    cache = PromptCache(CACHE_FILE)
     use_cache = False
+
+    # One-off migration of prompts from the old CSV log into the content-addressed cache
+    if len(cache) == 0 and os.path.exists(LOG_FILE):
+        try:
+            imported = cache.import_csv(LOG_FILE, PROMPT_KEY)
+            if imported:
+                print(f"Imported {imported} prompts from {LOG_FILE} into {CACHE_FILE}")
+        except Exception as e:
+            print(f"[!] Error reading log file: {e}")
     
-    if os.path.exists(LOG_FILE):
-        user_input = input("Would you like to reuse prompts from the log? (y/n): ").strip().lower()
+    cached_only = False
+    if len(cache) > 0:
+        user_input = input(f"Would you like to reuse cached prompts ({len(cache)} stored)? "
+                           f"(y/n, or 'only' to re-queue cached images without any LLM calls): ").strip().lower()
         if user_input == 'y':
             use_cache = True
-            cached_prompts = load_existing_prompts(LOG_FILE)
+        elif user_input == 'only':
+            cached_only = True
     
-    for filename in tqdm(files, unit="img"):
-        if stop_requested:
-            break
-            
-        try:
-            try:
-                shutil.copy2(filename, os.path.join(output_dir, filename))
-            except Exception as e:
-                print(f"\n[!] Error copying original file {filename}: {e}")
-
-            description = None
-            if use_cache and filename in cached_prompts:
-                description = cached_prompts[filename]
-            
-            if not description:
-                description = get_image_description(filename)
-            
-            if not description:
-                print(f"\n[!] Could not get description for {filename}")
-                continue
+    near_dups = None
+    if ENABLE_PHASH and not cached_only:
+        # Earlier runs' hashes are only trusted when reusing prompts was requested
+        # Namespaced like the other scripts ("animate:", "sorter:"); older runs stored the bare key
+        near_dups = PerceptualIndex(f"reimagine:{PROMPT_KEY}", PHASH_FILE, PHASH_MAX_DISTANCE,
+                                    load_existing=use_cache, legacy_namespace=PROMPT_KEY)
+    source = DescriptionSource(cache, use_cache, near_dups, cached_only)
+
+    if ENABLE_PIPELINE:
+        run_pipelined(submitter, files, output_dir, source)
+    else:
+        run_sequential(submitter, files, output_dir, source)
+
+    if stop_requested and CANCEL_QUEUED_ON_STOP:
+        cancelled = dispatcher.cancel_pending()
+        if cancelled:
+            print(f"\n[!] Removed {cancelled} queued job(s) from ComfyUI.")
 
-            # --- KEYWORD SWAP LOGIC (The Last Step) ---
-            if ENABLE_SWAPS:
-                # We only process up to the count specified in NUM_SWAPS
-                for i in range(min(len(KEYWORD_SWAPS), NUM_SWAPS)):
-                    old_word, new_word = KEYWORD_SWAPS[i]
-                    # Uses regex for case-insensitive replacement
-                    pattern = re.compile(re.escape(old_word), re.IGNORECASE)
-                    description = pattern.sub(new_word, description)
-            # ------------------------------------------
-                
-            w, h, ratio_desc = get_smart_dimensions(filename)
-            base_name = os.path.splitext(filename)[0]
-            output_prefix = f"{output_dir}/{base_name}_reimagined"
-            
-            if send_to_comfy(description, w, h, output_prefix):
-                log_task(filename, f"{w}x{h} ({ratio_desc})", description)
-            else:
-                print(f"\n[!] Failed to queue {filename} to ComfyUI")
-
-        except KeyboardInterrupt:
-            print("\n[!] Stop signal received. Finishing current task...")
-            stop_requested = True
+    cache.close()
+    prep.close()
+    print(lm.stats.report())
+    metrics.close()
+    if near_dups is not None:
+        print(f"Near-duplicates found: {near_dups.hits}")
+        near_dups.close()
 
     print(f"\nProcessing complete. Logs updated in {LOG_FILE}")
 
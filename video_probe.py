@@ -0,0 +1,312 @@
+import os
+import re
+import sys
+import json
+import shutil
+import sqlite3
+import argparse
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+
+# =================================================================================
+#  VIDEO METADATA PROBE
+#  Container-level metadata (resolution, fps, codec, audio format) without
+#  decoding a single frame. Uses ffprobe when it is on the PATH and falls back to
+#  parsing `ffmpeg -i` output (imageio-ffmpeg, which MoviePy installs, ships
+#  ffmpeg but not ffprobe).
+#
+#  ProbeCache keeps the results in SQLite keyed by path + size + mtime, so repeat
+#  runs over the same library never reopen a container.
+# =================================================================================
+
+DEFAULT_CACHE_FILE = "video_probe_cache.db"
+VIDEO_EXTS = ('.mp4', '.mkv', '.avi', '.mov', '.wmv', '.flv')
+
+CHANNEL_LAYOUTS = {"mono": 1, "stereo": 2, "2.1": 3, "quad": 4, "4.0": 4, "5.0": 5, "5.1": 6, "6.1": 7, "7.1": 8}
+
+def find_ffmpeg():
+    path = shutil.which("ffmpeg")
+    if path:
+        return path
+    try:
+        import imageio_ffmpeg
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except Exception:
+        return None
+
+def find_ffprobe():
+    return shutil.which("ffprobe")
+
+def _parse_rate(rate):
+    """'30000/1001' -> 29.97; None for '0/0' or junk."""
+    try:
+        if "/" in rate:
+            num, den = rate.split("/")
+            return float(num) / float(den) if float(den) else None
+        return float(rate)
+    except (TypeError, ValueError):
+        return None
+
+def _empty_info(path):
+    return {
+        "path": path, "width": None, "height": None, "fps": None, "frame_count": None,
+        "duration": None, "codec": None, "profile": None, "pix_fmt": None, "timescale": None,
+        "audio_codec": None, "sample_rate": None, "channels": None,
+    }
+
+def _probe_ffprobe(path, ffprobe):
+    result = subprocess.run(
+        [ffprobe, "-v", "error", "-show_format", "-show_streams", "-of", "json", path],
+        capture_output=True, text=True, timeout=60
+    )
+    if result.returncode != 0:
+        raise ValueError(result.stderr.strip() or "ffprobe failed")
+    data = json.loads(result.stdout)
+
+    info = _empty_info(path)
+    streams = data.get("streams", [])
+    video = next((s for s in streams if s.get("codec_type") == "video"), None)
+    audio = next((s for s in streams if s.get("codec_type") == "audio"), None)
+    if video is None:
+        raise ValueError("no video stream")
+
+    info["width"] = video.get("width")
+    info["height"] = video.get("height")
+    info["fps"] = _parse_rate(video.get("avg_frame_rate")) or _parse_rate(video.get("r_frame_rate"))
+    info["codec"] = video.get("codec_name")
+    info["profile"] = video.get("profile")
+    info["pix_fmt"] = video.get("pix_fmt")
+    time_base = _parse_rate(video.get("time_base"))
+    info["timescale"] = int(round(1 / time_base)) if time_base else None
+
+    duration = video.get("duration") or data.get("format", {}).get("duration")
+    info["duration"] = float(duration) if duration else None
+    if video.get("nb_frames", "").isdigit():
+        info["frame_count"] = int(video["nb_frames"])
+
+    if audio is not None:
+        info["audio_codec"] = audio.get("codec_name")
+        info["sample_rate"] = int(audio["sample_rate"]) if audio.get("sample_rate") else None
+        info["channels"] = audio.get("channels")
+    return info
+
+def _split_top_level(text):
+    """Splits an ffmpeg stream description on ', ' outside parentheses."""
+    parts, depth, current = [], 0, ""
+    for ch in text:
+        if ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+        if ch == "," and depth == 0:
+            parts.append(current.strip())
+            current = ""
+        else:
+            current += ch
+    if current.strip():
+        parts.append(current.strip())
+    return parts
+
+def _probe_ffmpeg(path, ffmpeg):
+    result = subprocess.run(
+        [ffmpeg, "-hide_banner", "-i", path], capture_output=True, text=True, errors="replace", timeout=60
+    )
+    output = result.stderr
+    info = _empty_info(path)
+
+    match = re.search(r"Duration: (\d+):(\d+):([\d.]+)", output)
+    if match:
+        h, m, sec = match.groups()
+        info["duration"] = int(h) * 3600 + int(m) * 60 + float(sec)
+
+    video_line = re.search(r"Stream #\d+:\d+.*?: Video: (.*)", output)
+    if not video_line:
+        raise ValueError("no video stream")
+    parts = _split_top_level(video_line.group(1))
+    codec_part = parts[0]
+    info["codec"] = codec_part.split()[0]
+    profile = re.search(r"\(([^)/]+)\)", codec_part)
+    if profile:
+        info["profile"] = profile.group(1).strip()
+    if len(parts) > 1:
+        info["pix_fmt"] = re.match(r"[\w]+", parts[1]).group(0)
+    for part in parts:
+        size = re.match(r"(\d{2,5})x(\d{2,5})", part)
+        if size and info["width"] is None:
+            info["width"], info["height"] = int(size.group(1)), int(size.group(2))
+        fps = re.match(r"([\d.]+)(k?) fps", part)
+        if fps:
+            info["fps"] = float(fps.group(1)) * (1000 if fps.group(2) else 1)
+        tbn = re.match(r"([\d.]+)(k?) tbn", part)
+        if tbn:
+            info["timescale"] = int(float(tbn.group(1)) * (1000 if tbn.group(2) else 1))
+    if info["fps"] is None:
+        tbr = re.search(r"([\d.]+)(k?) tbr", video_line.group(1))
+        if tbr:
+            info["fps"] = float(tbr.group(1)) * (1000 if tbr.group(2) else 1)
+
+    audio_line = re.search(r"Stream #\d+:\d+.*?: Audio: (.*)", output)
+    if audio_line:
+        parts = _split_top_level(audio_line.group(1))
+        info["audio_codec"] = parts[0].split()[0]
+        for part in parts[1:]:
+            rate = re.match(r"(\d+) Hz", part)
+            if rate:
+                info["sample_rate"] = int(rate.group(1))
+            layout = part.split("(")[0].strip()
+            if layout in CHANNEL_LAYOUTS:
+                info["channels"] = CHANNEL_LAYOUTS[layout]
+            channels = re.match(r"(\d+) channels", part)
+            if channels:
+                info["channels"] = int(channels.group(1))
+    return info
+
+def probe_video(path):
+    """Returns a metadata dict for one video. Raises ValueError if it has no readable video stream."""
+    ffprobe = find_ffprobe()
+    if ffprobe:
+        info = _probe_ffprobe(path, ffprobe)
+    else:
+        ffmpeg = find_ffmpeg()
+        if not ffmpeg:
+            raise ValueError("neither ffprobe nor ffmpeg is available")
+        info = _probe_ffmpeg(path, ffmpeg)
+
+    if not info["width"] or not info["height"] or not info["fps"]:
+        raise ValueError("incomplete video metadata")
+    if info["frame_count"] is None and info["duration"]:
+        info["frame_count"] = int(round(info["duration"] * info["fps"]))
+    return info
+
+class ProbeCache:
+    def __init__(self, path=DEFAULT_CACHE_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS probes (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                info TEXT NOT NULL
+            )
+        """)
+        self._conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _stat(path):
+        st = os.stat(path)
+        return os.path.abspath(path), st.st_size, st.st_mtime_ns
+
+    def lookup(self, path, allow_partial=False):
+        """Cached metadata if the file is unchanged since it was probed, else None.
+
+        Partial records (stored with partial=True, e.g. from cv2 without codec details)
+        are only returned when allow_partial is set."""
+        try:
+            key, size, mtime_ns = self._stat(path)
+        except OSError:
+            return None
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT info FROM probes WHERE path = ? AND size = ? AND mtime_ns = ?", (key, size, mtime_ns)
+            ).fetchone()
+        if row is None:
+            return None
+        info = json.loads(row[0])
+        if info.get("partial") and not allow_partial:
+            return None
+        info["path"] = path
+        return info
+
+    def put(self, path, info):
+        """Stores metadata for a file (e.g. values read from an already-open cv2 capture)."""
+        key, size, mtime_ns = self._stat(path)
+        record = dict(info)
+        record.pop("path", None)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO probes (path, size, mtime_ns, info) VALUES (?, ?, ?, ?)",
+                (key, size, mtime_ns, json.dumps(record))
+            )
+            self._conn.commit()
+
+    def get(self, path):
+        """Cached or freshly probed metadata. Raises ValueError if the file can't be probed."""
+        info = self.lookup(path)
+        if info is not None:
+            self.hits += 1
+            return info
+        self.misses += 1
+        info = probe_video(path)
+        self.put(path, info)
+        return info
+
+    def probe_many(self, paths, workers=8, show_progress=True):
+        """Bulk probe with parallel ffprobe/ffmpeg processes. Returns {path: info}; failures are skipped."""
+        results = {}
+        todo = []
+        for path in paths:
+            info = self.lookup(path)
+            if info is not None:
+                self.hits += 1
+                results[path] = info
+            else:
+                todo.append(path)
+
+        def probe(path):
+            try:
+                return path, probe_video(path), None
+            except Exception as e:
+                return path, None, e
+
+        if todo:
+            self.misses += len(todo)
+            with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+                for path, info, error in tqdm(pool.map(probe, todo), total=len(todo), unit="file",
+                                              desc="Probing", disable=not show_progress):
+                    if info is None:
+                        tqdm.write(f"Could not probe {path}: {error}")
+                        continue
+                    self.put(path, info)
+                    results[path] = info
+        return results
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+def find_videos(roots):
+    videos = []
+    for root_dir in roots:
+        for root, _, files in os.walk(root_dir):
+            for f in files:
+                if f.lower().endswith(VIDEO_EXTS):
+                    videos.append(os.path.join(root, f))
+    return videos
+
+def main():
+    parser = argparse.ArgumentParser(description="Probe a video library into the metadata cache.")
+    parser.add_argument("roots", nargs="*", default=["."], help="Directories to scan recursively")
+    parser.add_argument("--cache", default=DEFAULT_CACHE_FILE)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 4)
+    args = parser.parse_args()
+
+    if not find_ffprobe() and not find_ffmpeg():
+        print("Neither ffprobe nor ffmpeg was found.")
+        sys.exit(1)
+
+    videos = find_videos(args.roots)
+    print(f"Found {len(videos)} videos.")
+    cache = ProbeCache(args.cache)
+    results = cache.probe_many(videos, workers=args.workers)
+    print(f"{len(results)} probed ({cache.hits} already cached, {cache.misses} new) -> {args.cache}")
+    cache.close()
+
+if __name__ == "__main__":
+    main()